@@ -0,0 +1,62 @@
+""" tests for asyncrender.py, kept out of tests.py because
+they need Python 3.5+ and asgiref.
+"""
+
+import asyncio
+
+from django.test import TestCase
+from django.template import Template, Context
+
+from . import asyncrender
+
+
+def run(coroutine):
+    """ run coroutine to completion on a new event loop, as
+    asyncio.run does on Python 3.7+.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+class AsyncRenderTests(TestCase):
+
+    PAGE = (
+        "{% load macros %}"
+        "{% macro pair a b %}{{ a }},{{ b }};{% endmacro %}"
+        "{% use_macro pair first second %}")
+
+    def test_awaitable_arguments_gathered(self):
+        """ awaitable arguments should be awaited concurrently,
+        and the macro rendered with their results.
+        """
+        t = Template(self.PAGE)
+        started = []
+        async def argument(result):
+            # wait for the other argument to be awaited too.
+            started.append(result)
+            while len(started) < 2:
+                await asyncio.sleep(0.01)
+            return result
+        async def render():
+            # each argument times out unless both are awaited
+            # at once.
+            context = Context({
+                'first': asyncio.wait_for(argument('one'), 5),
+                'second': asyncio.wait_for(argument('two'), 5)})
+            return await asyncrender.render_async(t, context)
+        self.assertEqual(run(render()), "one,two;")
+
+    def test_render_node_async(self):
+        """ the async variant of a macro node's render should
+        give the same output as the sync one.
+        """
+        t = Template(self.PAGE)
+        node = t.nodelist[-1]
+        async def render():
+            context = Context({'first': 1,
+                               'second': asyncio.sleep(0, result=2)})
+            return await node.render_async(context)
+        self.assertEqual(run(render()), "1,2;")
@@ -0,0 +1,75 @@
+""" asyncrender.py, part of django-macros, renders templates
+using macros from async code, e.g. views served under ASGI.
+
+Macro arguments may be awaitables, such as the coroutines
+returned by async methods the template calls: the awaitable
+arguments of a macro call are awaited concurrently on the event
+loop, and the macro is rendered with their results. Arguments are
+only checked for awaitables in renders started from here. Template
+rendering itself, which may block (e.g. on lazy ORM lookups),
+runs off the event loop through asgiref's sync_to_async.
+
+This module requires Python 3.5+ and asgiref, which ships with
+Django 3.0+.
+"""
+
+import asyncio
+from contextlib import contextmanager
+from inspect import isawaitable
+
+from asgiref.sync import async_to_sync, sync_to_async
+
+
+async def resolve_awaitables(bindings):
+    """ return the (name, value) bindings with each awaitable
+    value replaced by its result, awaiting them concurrently.
+    """
+    pending = [(i, value) for i, (name, value) in enumerate(bindings)
+               if isawaitable(value)]
+    if not pending:
+        return bindings
+    results = await asyncio.gather(*(value for i, value in pending))
+    bindings = list(bindings)
+    for (i, value), result in zip(pending, results):
+        bindings[i] = (bindings[i][0], result)
+    return bindings
+
+
+def resolve_awaitables_sync(bindings):
+    """ resolve_awaitables, for synchronous rendering code.
+
+    Under render_async this awaits the arguments on the event
+    loop that the render was started from.
+    """
+    return async_to_sync(resolve_awaitables)(bindings)
+
+
+async def render_node(node, context):
+    """ render a UseMacroNode (or MacroBlockNode) from async
+    code.
+    """
+    with _rendering_async(context):
+        bindings = await sync_to_async(node.get_bindings)(context)
+        bindings = await resolve_awaitables(bindings)
+        return await sync_to_async(node.render_bound)(context, bindings)
+
+
+async def render_async(template, context):
+    """ render template (a django.template.Template) in
+    context without blocking the event loop.
+    """
+    with _rendering_async(context):
+        return await sync_to_async(template.render)(context)
+
+
+@contextmanager
+def _rendering_async(context):
+    # mark the context, so that the macro calls rendered in it
+    # look for awaitable arguments; other renders don't pay
+    # for checking.
+    rendering_async = getattr(context, 'rendering_async', False)
+    context.rendering_async = True
+    try:
+        yield
+    finally:
+        context.rendering_async = rendering_async
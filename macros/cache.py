@@ -0,0 +1,1060 @@
+""" cache.py, part of django-macros, stores the rendered
+output of cached macro calls ({% use_macro ... cache=300 %})
+in a django cache backend, and lets that output be invalidated
+by tag.
+
+Fragments are kept in up to four tiers: a small in-process LRU
+cache, consulted first, then optionally a memory mapped segment
+and a SQLite file, both shared by the processes on the host, in
+front of the shared django cache backend.
+Misses are rendered single-flight: only one thread in a process,
+and only one process sharing the backend, renders a missing
+fragment at a time, while the others wait for its result.
+Fragments may also be served stale while they are re-rendered
+on a background thread pool.
+"""
+
+import hashlib
+import mmap
+import os
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import cPickle as pickle
+except ImportError:
+    # Python 3
+    import pickle
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+
+from django.conf import settings
+from django.core.cache import caches, InvalidCacheBackendError
+from django.core.exceptions import ImproperlyConfigured
+from django.db import close_old_connections
+from django.utils.safestring import mark_safe
+
+try:
+    from django.utils.encoding import force_text
+except ImportError:
+    # Django >= 4.0
+    from django.utils.encoding import force_str as force_text
+
+
+FRAGMENT_KEY_TEMPLATE = 'macros.fragment.{0}.{1}.{2}'
+TAG_KEY_TEMPLATE = 'macros.tag.{0}'
+LOCK_KEY_TEMPLATE = 'macros.lock.{0}'
+
+# fragments at least this many bytes long (encoded as utf-8)
+# are stored compressed, at this zlib compression level. A
+# minimum size of None disables compression.
+MACROS_CACHE_COMPRESS_MIN_SIZE = 16 * 1024
+MACROS_CACHE_COMPRESS_LEVEL = 6
+
+# defaults for the in-process tier, each overridable by
+# the setting of the same name.
+MACROS_LOCAL_CACHE_ENTRIES = 1000
+MACROS_LOCAL_CACHE_BYTES = 10 * 1024 * 1024
+MACROS_LOCAL_CACHE_TIMEOUT = 5
+# the SQLite file backing the on-disk tier (None disables
+# it) and the total size of fragments it may hold.
+MACROS_DISK_CACHE_PATH = None
+MACROS_DISK_CACHE_MAX_BYTES = 100 * 1024 * 1024
+# the file memory mapped by the shared tier (None disables
+# it, and it is best kept on a tmpfs such as /dev/shm), its
+# size, and the size of each of its slots, which bounds the
+# size of the fragments it holds.
+MACROS_SHARED_CACHE_PATH = None
+MACROS_SHARED_CACHE_SIZE = 64 * 1024 * 1024
+MACROS_SHARED_CACHE_SLOT_SIZE = 64 * 1024
+# how long, in seconds, a render lock is held before it
+# lapses, and how often other processes poll for the result.
+MACROS_CACHE_LOCK_TIMEOUT = 10
+MACROS_CACHE_LOCK_POLL_INTERVAL = 0.05
+# the size of the pool refreshing stale fragments in the
+# background, and how many refreshes may be pending at once.
+MACROS_REFRESH_WORKERS = 2
+MACROS_REFRESH_QUEUE_SIZE = 100
+
+
+class TierStats(object):
+    """ hit and miss counts for one cache tier. """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def as_dict(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hit_rate}
+
+
+class LocalFragmentCache(object):
+    """ a bounded, thread safe, in-process LRU cache of
+    rendered fragments.
+
+    The cache holds at most max_entries fragments taking up at
+    most max_bytes (as measured by sys.getsizeof), and keeps
+    each for at most timeout seconds, so that fragments
+    invalidated by other processes are only served locally
+    for a short while.
+    """
+
+    def __init__(self, max_entries, max_bytes, timeout):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """ return the fragment stored at key, or None. """
+        with self._lock:
+            try:
+                value, size, expires = self._entries[key]
+            except KeyError:
+                return None
+            if expires <= time.time():
+                self._remove(key)
+                return None
+            # mark as most recently used
+            del self._entries[key]
+            self._entries[key] = (value, size, expires)
+            return value
+
+    def set(self, key, value, timeout=None, size=None):
+        """ store value at key for the local timeout, or for
+        timeout seconds if that's shorter.
+
+        size is the number of bytes value is counted as, which
+        defaults to sys.getsizeof(value); pass the size of the
+        fragment for entries wrapping one.
+        """
+        if timeout is None or timeout > self.timeout:
+            timeout = self.timeout
+        if size is None:
+            size = sys.getsizeof(value)
+        if timeout <= 0 or size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, time.time() + timeout)
+            self.size += size
+            # evict least recently used entries until both
+            # bounds are met.
+            while (len(self._entries) > self.max_entries or
+                   self.size > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        # the lock must be held.
+        value, size, expires = self._entries.pop(key)
+        self.size -= size
+
+
+class DiskFragmentCache(object):
+    """ a persistent fragment cache in a SQLite database
+    file, shared by every process on the host that opens it.
+
+    The database is used in WAL mode, so that readers don't
+    block each other or the writer. Values are pickled, and
+    once their total size exceeds max_bytes, expired and then
+    least recently used fragments are evicted.
+    """
+
+    # last access times are only written back if older than
+    # this many seconds, so that most hits are read only.
+    touch_interval = 1
+    # how long, in seconds, to wait for a lock on the database,
+    # and to wait to write back an access time, which is given
+    # up on rather than holding up a hit.
+    timeout = 5
+    touch_timeout = 0.05
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+
+    def _connection(self):
+        """ return this thread's connection to the database,
+        opening a new one in forked children.
+        """
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(
+                self.path, timeout=self.timeout, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS fragments ('
+                'key TEXT PRIMARY KEY, value BLOB, size INTEGER, '
+                'expires REAL, accessed REAL)')
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS fragments_accessed '
+                'ON fragments (accessed)')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS meta ('
+                'name TEXT PRIMARY KEY, value INTEGER)')
+            connection.execute(
+                "INSERT OR IGNORE INTO meta VALUES ('size', 0)")
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def get(self, key):
+        """ return the value stored at key, or None. """
+        now = time.time()
+        try:
+            connection = self._connection()
+            row = connection.execute(
+                'SELECT value, expires, accessed FROM fragments '
+                'WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            value, expires, accessed = row
+            if expires is not None and expires <= now:
+                self.delete(key)
+                return None
+        except sqlite3.Error:
+            # a busy or broken database is treated as a miss,
+            # rather than failing the render.
+            return None
+        if now - accessed > self.touch_interval:
+            self._touch(connection, key, now)
+        return pickle.loads(bytes(value))
+
+    def _touch(self, connection, key, now):
+        """ record an access to key for the LRU eviction, unless
+        the database is busy.
+        """
+        try:
+            connection.execute(
+                'PRAGMA busy_timeout = {0}'.format(
+                    int(self.touch_timeout * 1000)))
+            try:
+                connection.execute(
+                    'UPDATE fragments SET accessed = ? WHERE key = ?',
+                    (now, key))
+            finally:
+                connection.execute(
+                    'PRAGMA busy_timeout = {0}'.format(
+                        int(self.timeout * 1000)))
+        except sqlite3.Error:
+            pass
+
+    def set(self, key, value, timeout=None):
+        """ store value at key for timeout seconds, or
+        indefinitely if timeout is None.
+        """
+        now = time.time()
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        expires = None if timeout is None else now + timeout
+        try:
+            connection = self._connection()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                self._delete(connection, key)
+                connection.execute(
+                    'INSERT INTO fragments VALUES (?, ?, ?, ?, ?)',
+                    (key, sqlite3.Binary(data), len(data), expires, now))
+                connection.execute(
+                    "UPDATE meta SET value = value + ? WHERE name = 'size'",
+                    (len(data),))
+                self._evict(connection, now)
+            except Exception:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+        except sqlite3.Error:
+            pass
+
+    def delete(self, key):
+        try:
+            connection = self._connection()
+            connection.execute('BEGIN IMMEDIATE')
+            self._delete(connection, key)
+            connection.execute('COMMIT')
+        except sqlite3.Error:
+            pass
+
+    def clear(self):
+        try:
+            connection = self._connection()
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute('DELETE FROM fragments')
+            connection.execute("UPDATE meta SET value = 0 WHERE name = 'size'")
+            connection.execute('COMMIT')
+        except sqlite3.Error:
+            pass
+
+    @property
+    def size(self):
+        return self._connection().execute(
+            "SELECT value FROM meta WHERE name = 'size'").fetchone()[0]
+
+    def _delete(self, connection, key):
+        # must be called inside a write transaction.
+        row = connection.execute(
+            'SELECT size FROM fragments WHERE key = ?', (key,)).fetchone()
+        if row is not None:
+            connection.execute('DELETE FROM fragments WHERE key = ?', (key,))
+            connection.execute(
+                "UPDATE meta SET value = value - ? WHERE name = 'size'",
+                (row[0],))
+
+    def _evict(self, connection, now):
+        # must be called inside a write transaction.
+        size = connection.execute(
+            "SELECT value FROM meta WHERE name = 'size'").fetchone()[0]
+        if size <= self.max_bytes:
+            return
+        connection.execute(
+            'DELETE FROM fragments WHERE expires <= ?', (now,))
+        size = connection.execute(
+            'SELECT total(size) FROM fragments').fetchone()[0]
+        rows = connection.execute(
+            'SELECT key, size FROM fragments ORDER BY accessed')
+        evicted = []
+        for key, row_size in rows:
+            if size <= self.max_bytes:
+                break
+            evicted.append((key,))
+            size -= row_size
+        connection.executemany(
+            'DELETE FROM fragments WHERE key = ?', evicted)
+        connection.execute(
+            "UPDATE meta SET value = ? WHERE name = 'size'", (int(size),))
+
+
+class SharedFragmentCache(object):
+    """ a fixed size fragment cache in a memory mapped file,
+    shared by every process on the host that maps it, e.g.
+    pre-forked web server workers.
+
+    The file is divided into slots of slot_size bytes, and each
+    key is stored in the one slot its hash addresses, replacing
+    whatever was there. Each slot starts with a header::
+
+        sequence, key digest, expiry time, length, crc32
+
+    followed by the pickled value. Reads take no lock: like a
+    seqlock, a writer makes the sequence odd while it writes
+    and even again once done. A reader copies the value out of
+    the slot, and treats the slot as a miss if it then sees an
+    odd or changed sequence, or a checksum not matching its
+    copy. Writers to a slot are serialized between processes by
+    an fcntl lock on just that slot's bytes, and, as fcntl locks
+    are held by the whole process, between the threads of a
+    process by a lock striped over the slots.
+    """
+
+    header = struct.Struct('<Q16sdII')
+    # the number of thread locks the slots are striped over.
+    lock_stripes = 64
+
+    def __init__(self, path, size, slot_size):
+        if fcntl is None:
+            raise ImproperlyConfigured(
+                "The shared macro fragment cache requires fcntl, "
+                "which isn't available on this platform.")
+        self.path = path
+        self.slot_size = slot_size
+        self.slots = size // slot_size
+        self.size = self.slots * slot_size
+        self._map = None
+        self._file = None
+        self._map_lock = threading.Lock()
+        self._locks = [threading.Lock() for i in range(self.lock_stripes)]
+
+    def _mapping(self):
+        with self._map_lock:
+            if self._map is None:
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+                self._file = os.fdopen(fd, 'r+b')
+                if os.fstat(fd).st_size < self.size:
+                    os.ftruncate(fd, self.size)
+                self._map = mmap.mmap(fd, self.size)
+            return self._map
+
+    def _slot(self, key):
+        digest = hashlib.md5(force_text(key).encode('utf-8')).digest()
+        offset = (struct.unpack('<Q', digest[:8])[0] % self.slots *
+                  self.slot_size)
+        return digest, offset
+
+    @contextmanager
+    def _locked(self, offset):
+        """ hold the slot at offset for writing, against other
+        threads and other processes.
+        """
+        with self._locks[offset // self.slot_size % self.lock_stripes]:
+            fcntl.lockf(self._file, fcntl.LOCK_EX, self.slot_size, offset)
+            try:
+                yield
+            finally:
+                fcntl.lockf(self._file, fcntl.LOCK_UN, self.slot_size, offset)
+
+    def get(self, key):
+        """ return the value stored at key, or None. """
+        mapping = self._mapping()
+        digest, offset = self._slot(key)
+        sequence, slot_digest, expires, length, crc = \
+            self.header.unpack_from(mapping, offset)
+        if (sequence % 2 or slot_digest != digest or
+                length > self.slot_size - self.header.size):
+            return None
+        start = offset + self.header.size
+        # copy the value out, so that it can't change after
+        # it has been checked.
+        data = bytes(mapping[start:start + length])
+        if (self.header.unpack_from(mapping, offset)[0] != sequence or
+                zlib.crc32(data) & 0xffffffff != crc):
+            # the slot was rewritten while being read
+            return None
+        if expires and expires <= time.time():
+            return None
+        try:
+            return pickle.loads(data)
+        except Exception:
+            # a slot the checks missed being torn; a miss.
+            return None
+
+    def set(self, key, value, timeout=None):
+        """ store value at key for timeout seconds, or
+        indefinitely if timeout is None.
+
+        Values too large for a slot are not stored.
+        """
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.slot_size - self.header.size:
+            return
+        expires = 0.0 if timeout is None else time.time() + timeout
+        mapping = self._mapping()
+        digest, offset = self._slot(key)
+        with self._locked(offset):
+            sequence = self.header.unpack_from(mapping, offset)[0] | 1
+            # mark the slot as being written, then write the
+            # value, then the header with an even sequence.
+            struct.pack_into('<Q', mapping, offset, sequence)
+            start = offset + self.header.size
+            mapping[start:start + len(data)] = data
+            self.header.pack_into(
+                mapping, offset, sequence + 1, digest, expires, len(data),
+                zlib.crc32(data) & 0xffffffff)
+
+    def delete(self, key):
+        mapping = self._mapping()
+        digest, offset = self._slot(key)
+        with self._locked(offset):
+            sequence, slot_digest = \
+                self.header.unpack_from(mapping, offset)[:2]
+            if slot_digest == digest:
+                self.header.pack_into(
+                    mapping, offset, (sequence | 1) + 1,
+                    b'\0' * 16, 0.0, 0, 0)
+
+    def clear(self):
+        mapping = self._mapping()
+        for offset in range(0, self.size, self.slot_size):
+            with self._locked(offset):
+                sequence = self.header.unpack_from(mapping, offset)[0]
+                self.header.pack_into(
+                    mapping, offset, (sequence | 1) + 1,
+                    b'\0' * 16, 0.0, 0, 0)
+
+
+# the CPU time of the thread (Python 3.7+), or else of the
+# process.
+_cpu_time = getattr(time, 'thread_time', None) or getattr(
+    time, 'process_time', None) or time.clock
+
+
+class CompressionStats(object):
+    """ how much compressing fragments has saved, and what
+    it has cost, in CPU seconds.
+    """
+
+    def __init__(self):
+        self.compressed_count = 0
+        self.decompressed_count = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.compress_seconds = 0.0
+        self.decompress_seconds = 0.0
+
+    def compressed(self, bytes_in, bytes_out, seconds):
+        self.compressed_count += 1
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        self.compress_seconds += seconds
+
+    def decompressed(self, seconds):
+        self.decompressed_count += 1
+        self.decompress_seconds += seconds
+
+    @property
+    def ratio(self):
+        """ compressed size over original size, across all
+        fragments compressed so far.
+        """
+        return float(self.bytes_out) / self.bytes_in if self.bytes_in else 1.0
+
+    def as_dict(self):
+        return {'compressed': self.compressed_count,
+                'decompressed': self.decompressed_count,
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out,
+                'ratio': self.ratio,
+                'compress_seconds': self.compress_seconds,
+                'decompress_seconds': self.decompress_seconds}
+
+
+_local_cache = None
+_shared_cache = None
+_disk_cache = None
+_stats = {'local': TierStats(), 'shared': TierStats(),
+          'disk': TierStats(), 'backend': TierStats()}
+_compression_stats = CompressionStats()
+
+
+def get_local_cache():
+    """ return the in-process fragment cache, creating it
+    from settings on first use.
+
+    Returns None if MACROS_LOCAL_CACHE_ENTRIES is 0, which
+    disables the in-process tier.
+    """
+    global _local_cache
+    if _local_cache is None:
+        max_entries = getattr(settings, 'MACROS_LOCAL_CACHE_ENTRIES',
+                              MACROS_LOCAL_CACHE_ENTRIES)
+        if not max_entries:
+            return None
+        _local_cache = LocalFragmentCache(
+            max_entries,
+            getattr(settings, 'MACROS_LOCAL_CACHE_BYTES',
+                    MACROS_LOCAL_CACHE_BYTES),
+            getattr(settings, 'MACROS_LOCAL_CACHE_TIMEOUT',
+                    MACROS_LOCAL_CACHE_TIMEOUT))
+    return _local_cache
+
+
+def get_shared_cache():
+    """ return the memory mapped fragment cache, creating it
+    from settings on first use, or None if
+    MACROS_SHARED_CACHE_PATH isn't set.
+    """
+    global _shared_cache
+    if _shared_cache is None:
+        path = getattr(settings, 'MACROS_SHARED_CACHE_PATH',
+                       MACROS_SHARED_CACHE_PATH)
+        if path is None:
+            return None
+        _shared_cache = SharedFragmentCache(
+            path,
+            getattr(settings, 'MACROS_SHARED_CACHE_SIZE',
+                    MACROS_SHARED_CACHE_SIZE),
+            getattr(settings, 'MACROS_SHARED_CACHE_SLOT_SIZE',
+                    MACROS_SHARED_CACHE_SLOT_SIZE))
+    return _shared_cache
+
+
+def _host_tiers():
+    """ the tiers shared by the processes on this host, in
+    the order they are consulted, as (name, cache) pairs.
+    """
+    return [(name, cache) for name, cache in (
+        ('shared', get_shared_cache()), ('disk', get_disk_cache()))
+        if cache is not None]
+
+
+def get_disk_cache():
+    """ return the on-disk fragment cache, creating it from
+    settings on first use, or None if MACROS_DISK_CACHE_PATH
+    isn't set.
+    """
+    global _disk_cache
+    if _disk_cache is None:
+        path = getattr(settings, 'MACROS_DISK_CACHE_PATH',
+                       MACROS_DISK_CACHE_PATH)
+        if path is None:
+            return None
+        _disk_cache = DiskFragmentCache(
+            path,
+            getattr(settings, 'MACROS_DISK_CACHE_MAX_BYTES',
+                    MACROS_DISK_CACHE_MAX_BYTES))
+    return _disk_cache
+
+
+def cache_stats():
+    """ return hit and miss counts, and hit rates, for each
+    cache tier, as a dictionary keyed by tier name, along with
+    the compression ratio and time spent (de)compressing under
+    'compression'.
+    """
+    stats = dict((tier, stats.as_dict()) for tier, stats in _stats.items())
+    stats['compression'] = _compression_stats.as_dict()
+    return stats
+
+
+def reset_stats():
+    global _compression_stats
+    for tier in _stats:
+        _stats[tier] = TierStats()
+    _compression_stats = CompressionStats()
+
+
+def get_cache():
+    """ return the django cache backend that macro fragments
+    are stored in.
+
+    The alias is read from the MACROS_CACHE setting, falling
+    back to a 'template_fragments' cache if one is configured
+    (as django's own {% cache %} tag does), and finally to the
+    default cache.
+    """
+    alias = getattr(settings, 'MACROS_CACHE', None)
+    if alias is not None:
+        return caches[alias]
+    try:
+        return caches['template_fragments']
+    except InvalidCacheBackendError:
+        return caches['default']
+
+
+def _hash(parts):
+    """ md5 hex digest of an iterable of values, each value
+    converted to text first.
+    """
+    key = ':'.join(force_text(part) for part in parts)
+    return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+
+def _new_generation():
+    """ a fresh generation number for a tag.
+
+    Generations start from the current time, rather than zero,
+    so that a tag key evicted from the cache and then recreated
+    can never fall back to a generation that stale fragments
+    were stored under.
+    """
+    return int(time.time() * 1000)
+
+
+def parse_tags(value):
+    """ split a rendered tags option ("product:1, user:2" or
+    "product:1 user:2") into a sorted tuple of unique tags.
+    """
+    return tuple(sorted(set(
+        tag for tag in force_text(value).replace(',', ' ').split()
+        if tag)))
+
+
+def tag_generations(tags, cache=None):
+    """ return the current generation of each of tags, as a
+    list in the same order as tags.
+
+    Generations are read from the in-process tier where
+    possible, and the rest are fetched in one get_many call;
+    tags that have never been seen (or were evicted) are given
+    a fresh generation.
+    """
+    if not tags:
+        return []
+    if cache is None:
+        cache = get_cache()
+    local = get_local_cache()
+    keys = [TAG_KEY_TEMPLATE.format(tag) for tag in tags]
+    found = {}
+    if local is not None:
+        for key in keys:
+            generation = local.get(key)
+            if generation is not None:
+                found[key] = generation
+    missing = [key for key in keys if key not in found]
+    if missing:
+        found.update(cache.get_many(missing))
+    generations = []
+    for key in keys:
+        if key not in found:
+            # add, not set, so that a concurrent invalidation
+            # or initialization wins.
+            cache.add(key, _new_generation(), None)
+            found[key] = cache.get(key)
+        if key in missing and local is not None:
+            local.set(key, found[key])
+        generations.append(found[key])
+    return generations
+
+
+def invalidate_tags(*tags):
+    """ invalidate every cached macro fragment that was stored
+    with any of tags.
+
+    Nothing is deleted: each tag's generation counter is bumped,
+    so the keys of fragments stored under the old generation are
+    simply never looked up again and age out of the backend.
+    This is a single cache operation per tag, however many
+    fragments carry it. Other processes see the invalidation
+    once their in-process copy of the generation expires, after
+    at most MACROS_LOCAL_CACHE_TIMEOUT seconds.
+    """
+    cache = get_cache()
+    local = get_local_cache()
+    for tag in tags:
+        key = TAG_KEY_TEMPLATE.format(tag)
+        try:
+            cache.incr(key)
+        except ValueError:
+            # the tag has no generation yet, so no fragment can
+            # have been stored under it; start a new one anyway
+            # in case a fragment is being stored right now.
+            cache.set(key, _new_generation(), None)
+        if local is not None:
+            local.delete(key)
+
+
+def make_fragment_key(macro_name, vary_on=(), tags=(), cache=None):
+    """ build the cache key for a macro called with the bound
+    argument values vary_on and carrying the invalidation tags.
+    """
+    generations = tag_generations(tags, cache)
+    return FRAGMENT_KEY_TEMPLATE.format(
+        macro_name,
+        _hash(vary_on),
+        _hash(zip(tags, generations)))
+
+
+def get_entry(key):
+    """ return the (fragment, fresh) pair stored at key, or
+    None, trying the in-process tier, then the tiers shared by
+    the processes on the host, before the cache backend.
+
+    fresh is False once the fragment's cache timeout has passed
+    but it is still being kept to be served stale.
+    """
+    local = get_local_cache()
+    if local is not None:
+        entry = local.get(key)
+        if entry is not None:
+            _stats['local'].hits += 1
+            return _unpack(entry)
+        _stats['local'].misses += 1
+    # tiers missed so far, to be filled from the tier that hits
+    missed = []
+    entry = None
+    for name, tier in _host_tiers():
+        entry = tier.get(key)
+        if entry is not None:
+            _stats[name].hits += 1
+            break
+        _stats[name].misses += 1
+        missed.append(tier)
+    if entry is None:
+        entry = get_cache().get(key)
+        if entry is None:
+            _stats['backend'].misses += 1
+            return None
+        _stats['backend'].hits += 1
+    for tier in missed:
+        tier.set(key, entry, _remaining(entry))
+    entry = _decompress_entry(entry)
+    if local is not None:
+        local.set(key, entry, _remaining(entry), _entry_size(entry))
+    return _unpack(entry)
+
+
+def get_fragment(key):
+    """ return the fresh fragment stored at key, or None. """
+    entry = get_entry(key)
+    if entry is None or not entry[1]:
+        return None
+    return entry[0]
+
+
+def set_fragment(key, value, timeout, stale=0):
+    """ store a rendered fragment at key, in every tier, to be
+    served fresh for timeout seconds and then stale for a
+    further stale seconds.
+    """
+    if timeout is None:
+        entry = (value, None, None)
+        backend_timeout = None
+    else:
+        now = time.time()
+        entry = (value, now + timeout, now + timeout + stale)
+        backend_timeout = timeout + stale
+    compressed = _compress_entry(entry)
+    get_cache().set(key, compressed, backend_timeout)
+    for name, tier in _host_tiers():
+        tier.set(key, compressed, backend_timeout)
+    local = get_local_cache()
+    if local is not None:
+        local.set(key, entry, backend_timeout, _entry_size(entry))
+
+
+def _entry_size(entry):
+    """ the size of an entry's fragment, which the local tier
+    is bounded by, rather than of the entry's tuple.
+    """
+    return sys.getsizeof(entry[0])
+
+
+class CompressedFragment(object):
+    """ a fragment stored in the cache backend as zlib
+    compressed utf-8.
+    """
+
+    def __init__(self, data):
+        self.data = data
+
+
+def _compress_entry(entry):
+    """ return entry with its fragment compressed, if the
+    fragment is at least MACROS_CACHE_COMPRESS_MIN_SIZE bytes
+    long when encoded.
+    """
+    value = entry[0]
+    min_size = getattr(settings, 'MACROS_CACHE_COMPRESS_MIN_SIZE',
+                       MACROS_CACHE_COMPRESS_MIN_SIZE)
+    if min_size is None or len(value) * 4 < min_size:
+        # even at four bytes a character, too short to bother
+        return entry
+    encoded = value.encode('utf-8')
+    if len(encoded) < min_size:
+        return entry
+    start = _cpu_time()
+    data = zlib.compress(
+        encoded,
+        getattr(settings, 'MACROS_CACHE_COMPRESS_LEVEL',
+                MACROS_CACHE_COMPRESS_LEVEL))
+    _compression_stats.compressed(len(encoded), len(data),
+                                  _cpu_time() - start)
+    return (CompressedFragment(data),) + tuple(entry[1:])
+
+
+def _decompress_entry(entry):
+    """ return entry with its fragment decompressed, if it
+    was stored compressed.
+    """
+    value = entry[0]
+    if not isinstance(value, CompressedFragment):
+        return entry
+    start = _cpu_time()
+    value = mark_safe(zlib.decompress(value.data).decode('utf-8'))
+    _compression_stats.decompressed(_cpu_time() - start)
+    return (value,) + tuple(entry[1:])
+
+
+def _unpack(entry):
+    value, fresh_until, expires = entry
+    return value, fresh_until is None or fresh_until > time.time()
+
+
+def _remaining(entry):
+    """ the number of seconds entry has left to be served,
+    fresh or stale.
+    """
+    expires = entry[2]
+    if expires is None:
+        return None
+    return expires - time.time()
+
+
+class _Flight(object):
+    """ an in-progress render of one fragment, which other
+    threads in the process can wait on.
+    """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+
+
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+def get_or_render(key, render, timeout, stale=0, snapshot=None):
+    """ return the fragment stored at key, calling render()
+    to produce and store it on a miss.
+
+    Concurrent misses for the same key are collapsed: within
+    the process, one thread renders while the others wait on
+    it, and across processes the renderer holds a lock key in
+    the cache backend (see _render_locked).
+
+    If stale is given, a fragment past its timeout is still
+    returned for up to stale more seconds, and it is refreshed
+    in the background by the function snapshot() returns (by
+    default, render itself), which mustn't depend on state
+    the caller goes on to change.
+    """
+    entry = get_entry(key)
+    if entry is not None:
+        value, fresh = entry
+        if fresh:
+            return value
+        if stale:
+            schedule_refresh(
+                key, snapshot or (lambda: render), timeout, stale)
+            return value
+
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = _Flight()
+
+    if not leader:
+        flight.event.wait(_lock_timeout())
+        if flight.value is not None:
+            return flight.value
+        # the leading thread failed, or is taking longer
+        # than the lock lease; render without it.
+        return render()
+
+    try:
+        flight.value = _render_locked(key, render, timeout, stale)
+        return flight.value
+    finally:
+        with _flights_lock:
+            del _flights[key]
+        flight.event.set()
+
+
+def _lock_timeout():
+    return getattr(settings, 'MACROS_CACHE_LOCK_TIMEOUT',
+                   MACROS_CACHE_LOCK_TIMEOUT)
+
+
+def _render_locked(key, render, timeout, stale=0):
+    """ render and store the fragment at key while holding
+    its lock in the cache backend.
+
+    If another process holds the lock, poll the backend for
+    the fragment it is rendering until the lock's lease runs
+    out, taking the lock over if it is released without a
+    fragment being stored.
+    """
+    cache = get_cache()
+    lock_key = LOCK_KEY_TEMPLATE.format(key)
+    lease = _lock_timeout()
+    poll_interval = getattr(settings, 'MACROS_CACHE_LOCK_POLL_INTERVAL',
+                            MACROS_CACHE_LOCK_POLL_INTERVAL)
+
+    locked = cache.add(lock_key, 1, lease)
+    deadline = time.time() + lease
+    while not locked and time.time() < deadline:
+        time.sleep(poll_interval)
+        entry = cache.get(key)
+        if entry is not None and _unpack(entry)[1]:
+            return _decompress_entry(entry)[0]
+        locked = cache.add(lock_key, 1, lease)
+
+    try:
+        value = render()
+        set_fragment(key, value, timeout, stale)
+    finally:
+        if locked:
+            cache.delete(lock_key)
+    return value
+
+
+_refresh_executor = None
+_refreshes = {}
+_refreshes_lock = threading.Lock()
+
+
+def _get_refresh_executor():
+    global _refresh_executor
+    if _refresh_executor is None:
+        # imported here so that python 2 installs without the
+        # futures backport can still use everything else.
+        from concurrent.futures import ThreadPoolExecutor
+        _refresh_executor = ThreadPoolExecutor(
+            getattr(settings, 'MACROS_REFRESH_WORKERS',
+                    MACROS_REFRESH_WORKERS))
+    return _refresh_executor
+
+
+def schedule_refresh(key, snapshot, timeout, stale=0):
+    """ re-render the fragment at key on the background
+    refresh pool, unless it is already being refreshed.
+
+    snapshot() is only called if the refresh is scheduled, and
+    returns the function that renders the fragment.
+
+    At most MACROS_REFRESH_QUEUE_SIZE refreshes are pending at
+    once; further requests are dropped, and the stale fragment
+    is served until a later request schedules the refresh.
+    """
+    with _refreshes_lock:
+        if key in _refreshes or len(_refreshes) >= getattr(
+                settings, 'MACROS_REFRESH_QUEUE_SIZE',
+                MACROS_REFRESH_QUEUE_SIZE):
+            return None
+        future = _get_refresh_executor().submit(
+            _refresh, key, snapshot(), timeout, stale)
+        _refreshes[key] = future
+    return future
+
+
+def _refresh(key, render, timeout, stale):
+    cache = get_cache()
+    lock_key = LOCK_KEY_TEMPLATE.format(key)
+    try:
+        # another process is already rendering the fragment.
+        if not cache.add(lock_key, 1, _lock_timeout()):
+            return
+        try:
+            set_fragment(key, render(), timeout, stale)
+        finally:
+            cache.delete(lock_key)
+    finally:
+        with _refreshes_lock:
+            del _refreshes[key]
+        # as at the end of a request, so that renders using the
+        # ORM don't leave connections open on the pool's threads.
+        close_old_connections()
+
+
+def wait_for_refreshes(timeout=None):
+    """ block until the background refreshes scheduled so far
+    have finished, e.g. in tests or at shutdown.
+    """
+    from concurrent.futures import wait
+    with _refreshes_lock:
+        futures = list(_refreshes.values())
+    wait(futures, timeout)
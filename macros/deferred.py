@@ -0,0 +1,124 @@
+""" deferred.py, part of django-macros, renders the macro calls
+marked deferred ({% use_macro ... deferred %}) concurrently.
+
+Rendering happens in two phases. In the first, the template is
+rendered as usual, except that each deferred call only captures
+its resolved arguments and a copy of the context, and outputs a
+placeholder. In the second, the captured calls are rendered on a
+thread pool and spliced into the output in place of their
+placeholders, giving the same output as rendering them in turn.
+This pays off when the deferred macros spend their time waiting
+on I/O, e.g. through methods called by the template.
+
+Each captured call renders in its own copy of the context, as it
+was when the call was made, with its own render context state,
+so tags keeping state there don't share it between threads. The
+values in the context are shared, though, and must be safe to use
+from several threads at once. The active language and time zone
+are carried over to the thread the call renders on, and the
+thread's stale database connections are closed after the call,
+as they are after a request.
+"""
+
+import re
+import threading
+import uuid
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils import timezone, translation
+from django.utils.safestring import mark_safe
+
+
+PLACEHOLDER_TEMPLATE = '<!--macros-deferred:{0}:{1}-->'
+PLACEHOLDER_RE_TEMPLATE = r'<!--macros-deferred:{0}:(\d+)-->'
+
+# the size of the pool deferred macros are rendered on.
+MACROS_DEFERRED_WORKERS = 4
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # imported here so that python 2 installs without the
+            # futures backport can still use everything else.
+            from concurrent.futures import ThreadPoolExecutor
+            _executor = ThreadPoolExecutor(
+                getattr(settings, 'MACROS_DEFERRED_WORKERS',
+                        MACROS_DEFERRED_WORKERS))
+    return _executor
+
+
+class DeferredRenders(object):
+    """ the deferred macro calls captured during the first
+    phase of a render.
+    """
+
+    def __init__(self):
+        # a per render nonce, so that placeholders can't be
+        # confused with content, or with another render's.
+        self.nonce = uuid.uuid4().hex
+        self.renders = []
+
+    def defer(self, render):
+        """ capture render, a function rendering a macro call,
+        and return the placeholder for its output.
+        """
+        # the active language and time zone are thread local,
+        # so carry them over to the thread the call is rendered
+        # on.
+        language = translation.get_language()
+        tz = timezone.get_current_timezone()
+
+        def render_in_thread():
+            try:
+                with translation.override(language):
+                    with timezone.override(tz):
+                        return render()
+            finally:
+                close_old_connections()
+
+        self.renders.append(render_in_thread)
+        return mark_safe(PLACEHOLDER_TEMPLATE.format(
+            self.nonce, len(self.renders) - 1))
+
+    def splice(self, output):
+        """ render the captured calls concurrently, and return
+        output with their placeholders replaced by the results.
+        """
+        if not self.renders:
+            return output
+        futures = [_get_executor().submit(render) for render in self.renders]
+        pattern = re.compile(PLACEHOLDER_RE_TEMPLATE.format(self.nonce))
+        return mark_safe(pattern.sub(
+            lambda match: futures[int(match.group(1))].result(), output))
+
+
+def render_deferred(template, context):
+    """ render template (a django.template.Template) in
+    context, rendering its deferred macro calls concurrently.
+    """
+    context.deferred_renders = DeferredRenders()
+    try:
+        output = template.render(context)
+        return context.deferred_renders.splice(output)
+    finally:
+        context.deferred_renders = None
+
+
+@contextmanager
+def suspended(context):
+    """ render deferred calls in place, e.g. while rendering
+    output that will outlive the current render.
+    """
+    deferred_renders = getattr(context, 'deferred_renders', None)
+    context.deferred_renders = None
+    try:
+        yield
+    finally:
+        context.deferred_renders = deferred_renders
@@ -0,0 +1,188 @@
+""" holes.py, part of django-macros, caches whole pages while
+leaving "holes" for the macro calls marked dynamic
+({% use_macro ... dynamic %}), which are filled in on every
+request.
+
+A page is rendered once into a skeleton, in which each dynamic
+call is replaced by a signed placeholder naming the macro and
+carrying its resolved arguments. The skeleton is cached, and
+each request only renders the dynamic macros into it.
+"""
+
+import re
+import uuid
+import weakref
+
+from django.core import signing
+from django.http import HttpResponse
+from django.template import TemplateSyntaxError
+from django.template.loader import get_template
+from django.utils.safestring import mark_safe, SafeData
+
+try:
+    from django.template.context import make_context
+except ImportError:
+    # Django < 1.8
+    make_context = None
+
+from . import cache as macro_cache
+
+
+PLACEHOLDER_TEMPLATE = '<!--macros-hole:{0}-->'
+PLACEHOLDER_RE = re.compile(r'<!--macros-hole:([\w.:-]+)-->')
+SIGNING_SALT = 'macros.holes'
+
+# macros that have rendered a placeholder in this process, keyed
+# by an id given to each macro definition, so that holes in pages
+# from templates that weren't loaded by name (or whose macros
+# were defined in a {% loadmacros %} sheet) can still be filled,
+# and a redefined macro fills its own holes.
+_macros = weakref.WeakValueDictionary()
+
+
+def _template_name(macro):
+    origin = getattr(macro, 'origin', None)
+    return getattr(origin, 'template_name', None) or getattr(
+        origin, 'name', None)
+
+
+def _position(macro):
+    # where the macro is defined in its template's source, to
+    # tell apart macros of the same name when the template is
+    # loaded again, e.g. in another process.
+    position = getattr(getattr(macro, 'token', None), 'position', None)
+    return list(position) if position is not None else None
+
+
+def _macro_id(macro):
+    try:
+        return macro.hole_id
+    except AttributeError:
+        macro.hole_id = uuid.uuid4().hex
+        return macro.hole_id
+
+
+def placeholder(macro, bindings):
+    """ return the placeholder for a dynamic call of macro
+    with the resolved (name, value) bindings.
+    """
+    macro_id = _macro_id(macro)
+    _macros[macro_id] = macro
+    arguments = [[name, value, isinstance(value, SafeData)]
+                 for name, value in bindings]
+    try:
+        payload = signing.dumps(
+            {'i': macro_id, 't': _template_name(macro), 'm': macro.name,
+             'p': _position(macro), 'a': arguments},
+            salt=SIGNING_SALT, compress=True)
+    except TypeError:
+        raise TemplateSyntaxError(
+            "Arguments to the dynamic call of macro '{0}' must be "
+            "json serializable.".format(macro.name))
+    return mark_safe(PLACEHOLDER_TEMPLATE.format(payload))
+
+
+def _find_macro(payload):
+    try:
+        return _macros[payload['i']]
+    except KeyError:
+        pass
+    template_name = payload['t']
+    if template_name is None:
+        return None
+    # circular import
+    from .templatetags.macros import DefineMacroNode
+    t = get_template(template_name)
+    try:
+        # Works for Django 1.8
+        nodelist = t.template.nodelist
+    except AttributeError:
+        # Works for Django < 1.8
+        nodelist = t.nodelist
+    # including the macros loaded by {% loadmacros %} tags.
+    macros = nodelist.get_nodes_by_type(DefineMacroNode)
+    found = None
+    for macro in macros:
+        if macro.name == payload['m'] and _template_name(macro) == (
+                template_name):
+            # the last definition, unless one is at the
+            # placeholder's position.
+            if found is None or _position(found) != payload['p']:
+                found = macro
+    if found is not None:
+        _macros[payload['i']] = found
+    return found
+
+
+def fill_holes(skeleton, context, template=None):
+    """ render each dynamic macro call left as a placeholder
+    in skeleton, in context, and return the completed page.
+
+    template, the template the skeleton was rendered from, is
+    bound to the context while the holes are rendered, if the
+    context isn't already bound to one.
+
+    Placeholders with a bad signature, e.g. ones that came
+    from user content rather than the skeleton render, are
+    left as they are.
+    """
+    def fill(match):
+        try:
+            payload = signing.loads(match.group(1), salt=SIGNING_SALT)
+        except signing.BadSignature:
+            return match.group(0)
+        macro = _find_macro(payload)
+        if macro is None:
+            raise TemplateSyntaxError(
+                "Macro '{0}' for a dynamic call could not be "
+                "found.".format(payload['m']))
+        bindings = dict(
+            (name, mark_safe(value) if safe else value)
+            for name, value, safe in payload['a'])
+        context.push(bindings)
+        try:
+            return macro.nodelist.render(context)
+        finally:
+            context.pop()
+    if (template is not None and hasattr(context, 'bind_template') and
+            context.template is None):
+        with context.bind_template(template):
+            return mark_safe(PLACEHOLDER_RE.sub(fill, skeleton))
+    return mark_safe(PLACEHOLDER_RE.sub(fill, skeleton))
+
+
+def render_skeleton(template, context):
+    """ render template (a django.template.Template) in
+    context, leaving placeholders for dynamic macro calls.
+    """
+    context.render_holes = True
+    try:
+        return template.render(context)
+    finally:
+        context.render_holes = False
+
+
+def render_with_holes(request, template_name, context=None, timeout=None,
+                      key=None):
+    """ return an HttpResponse of template_name rendered with
+    context for request, rendering the page's skeleton through
+    the macro fragment cache, for timeout seconds, and filling
+    its holes for this request.
+
+    The skeleton is cached by template name and key, which
+    defaults to the request's full path.
+    """
+    t = get_template(template_name)
+    t = getattr(t, 'template', t)
+    if make_context is not None:
+        context = make_context(context, request)
+    else:
+        from django.template import RequestContext
+        context = RequestContext(request, context)
+    if key is None:
+        key = request.get_full_path()
+    cache_key = macro_cache.make_fragment_key(
+        'page:' + template_name, [key])
+    skeleton = macro_cache.get_or_render(
+        cache_key, lambda: render_skeleton(t, context), timeout)
+    return HttpResponse(fill_holes(skeleton, context, t))
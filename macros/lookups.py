@@ -0,0 +1,272 @@
+""" lookups.py, part of django-macros, speeds up resolving
+dotted variables, such as {{ row.product.name }}, in macro bodies
+and macro call arguments.
+
+Django resolves each segment of a dotted variable by trying a
+dictionary lookup, then an attribute lookup, then a list index,
+on every resolve. CachedVariable keeps an inline cache for each
+segment, remembering which of these succeeded for the type last
+seen there. While the type stays the same, a segment goes
+straight to that lookup; when the type changes, or the cached
+lookup fails, it falls back to Django's order and updates the
+cache.
+
+Call sites marked memo ({% use_macro ... memo %}) also memoize
+their dotted arguments for the rest of the render, keyed on the
+expression and the object its first segment names, so that e.g.
+request.user.profile is only looked up once however many calls
+pass it. This assumes the lookups have no side effects, and that
+their results don't change during the render.
+"""
+
+import logging
+import weakref
+
+from django.conf import settings
+from django.template.base import (
+    BaseContext, Variable, VariableDoesNotExist, VariableNode)
+
+try:
+    from inspect import signature
+
+    def _check_no_arguments(func):
+        signature(func).bind()
+except ImportError:
+    # Python 2
+    from inspect import getcallargs as _check_no_arguments
+
+
+logger = logging.getLogger('django.template')
+
+# the lookups a segment can be cached as.
+ITEM, ATTRIBUTE, INDEX = 'item', 'attribute', 'index'
+
+# the exceptions meaning a dictionary lookup didn't apply,
+# as in Variable._resolve_lookup.
+ITEM_ERRORS = (TypeError, AttributeError, KeyError, ValueError, IndexError)
+
+
+def _string_if_invalid(context):
+    try:
+        return context.template.engine.string_if_invalid
+    except AttributeError:
+        # Django < 1.8, or a context not bound to a template
+        return getattr(settings, 'TEMPLATE_STRING_IF_INVALID', '')
+
+
+def _lookup(current, bit, tried=None):
+    """ look bit up on current in Django's order, returning
+    the value and which lookup found it. tried is a lookup
+    that has already failed, and isn't tried again.
+    """
+    try:
+        if tried != ITEM:
+            return current[bit], ITEM
+    except ITEM_ERRORS:
+        pass
+    try:
+        if tried == ATTRIBUTE:
+            raise AttributeError
+        # Don't return class attributes if the class is the context:
+        if isinstance(current, BaseContext) and getattr(type(current), bit):
+            raise AttributeError
+        return getattr(current, bit), ATTRIBUTE
+    except (TypeError, AttributeError):
+        # Reraise if the exception was raised by a @property
+        if not isinstance(current, BaseContext) and bit in dir(current):
+            raise
+    try:
+        return current[int(bit)], INDEX
+    except (IndexError, ValueError, KeyError, TypeError):
+        raise VariableDoesNotExist(
+            "Failed lookup for key [%s] in %r", (bit, current))
+
+
+def _cacheable(kind, lookup):
+    """ whether a lookup found on an object of type kind can
+    skip straight to that lookup on other objects of the type.
+    """
+    if lookup == ITEM:
+        # a failed dictionary lookup falls back to the rest.
+        return True
+    if issubclass(kind, BaseContext):
+        return False
+    # an attribute or index lookup is only ever reached on a
+    # type whose dictionary lookup always fails.
+    return getattr(kind, '__getitem__', None) is None or (
+        lookup == INDEX and kind in (list, tuple))
+
+
+class CachedVariable(Variable):
+    """ a template.Variable with an inline cache of the
+    lookup used for each segment of its dotted name.
+    """
+
+    def __init__(self, var):
+        if isinstance(var, Variable):
+            # share the parsed parts of a variable already
+            # compiled, keeping it alive with this one.
+            self.__dict__.update(vars(var))
+            self.parsed = var
+        else:
+            super(CachedVariable, self).__init__(var)
+        if self.lookups is not None:
+            # (type, lookup, key) for each segment, or None
+            # for a segment not yet resolved.
+            self.lookup_cache = [None] * len(self.lookups)
+
+    def _resolve_lookup(self, context):
+        current = context
+        cache = self.lookup_cache
+        bit = None
+        try:  # catch-all for silent variable failures
+            for i, bit in enumerate(self.lookups):
+                entry = cache[i]
+                tried = None
+                if entry is not None and type(current) is entry[0]:
+                    # the guard holds: try the cached lookup.
+                    tried = entry[1]
+                    if tried == ATTRIBUTE:
+                        try:
+                            current = getattr(current, bit)
+                            tried = None
+                        except (TypeError, AttributeError):
+                            # Reraise if the exception was raised by a @property
+                            if bit in dir(current):
+                                raise
+                    else:
+                        try:
+                            current = current[entry[2]]
+                            tried = None
+                        except ITEM_ERRORS:
+                            pass
+                    if tried is None:
+                        if callable(current):
+                            current = self._call(current, context)
+                        continue
+                # fall back to the full lookup, skipping any cached
+                # lookup that just failed, and cache what works.
+                kind = type(current)
+                current, lookup = _lookup(current, bit, tried)
+                if _cacheable(kind, lookup):
+                    cache[i] = (
+                        kind, lookup, int(bit) if lookup == INDEX else bit)
+                else:
+                    cache[i] = None
+                if callable(current):
+                    current = self._call(current, context)
+        except Exception as e:
+            template_name = getattr(context, 'template_name', None) or 'unknown'
+            logger.debug(
+                "Exception while resolving variable '%s' in template '%s'.",
+                bit, template_name, exc_info=True)
+            if getattr(e, 'silent_variable_failure', False):
+                current = _string_if_invalid(context)
+            else:
+                raise
+        return current
+
+    def _call(self, func, context):
+        if getattr(func, 'do_not_call_in_templates', False):
+            return func
+        if getattr(func, 'alters_data', False):
+            return _string_if_invalid(context)
+        try:  # method call (assuming no args required)
+            return func()
+        except TypeError:
+            try:
+                _check_no_arguments(func)
+            except TypeError:  # arguments *were* required
+                return _string_if_invalid(context)
+            raise
+
+
+# the variables parsed so far, keyed by expression, so that call
+# sites and macro bodies repeating an expression share its parsed
+# parts. Each gets its own inline caches, as a call site sees its
+# own types. Variables are dropped once no compiled template
+# holds them.
+_interned = weakref.WeakValueDictionary()
+
+
+def interned(var):
+    """ return a CachedVariable for the expression var, with its
+    own inline cache, sharing the parsed expression with the other
+    variables for it. Literals, which have no cache, are shared
+    whole.
+    """
+    try:
+        parsed = _interned[var]
+    except KeyError:
+        # parsed outside of the table, so that a malformed
+        # expression raises as usual.
+        parsed = _interned.setdefault(var, Variable(var))
+    if parsed.lookups is None:
+        return parsed
+    return CachedVariable(parsed)
+
+
+def cache_lookups(nodelist):
+    """ give the {{ variables }} in nodelist (and the nodelists
+    inside it) inline lookup caches, in place.
+    """
+    for node in nodelist.get_nodes_by_type(VariableNode):
+        expression = node.filter_expression
+        if isinstance(expression.var, Variable) and not isinstance(
+                expression.var, CachedVariable):
+            expression.var = cached(expression.var)
+
+
+def cached(variable):
+    """ return a CachedVariable for variable, or variable
+    itself if it is a literal.
+    """
+    if variable.lookups is None:
+        return variable
+    return interned(variable.var)
+
+
+# the render_context key of the memo for memoized arguments.
+MEMO_KEY = 'macros.lookups.memo'
+
+
+class MemoizedVariable(object):
+    """ a dotted template variable, whose value is memoized for
+    the rest of the render on the first lookup.
+    """
+
+    def __init__(self, variable):
+        self.variable = variable
+        self.var = variable.var
+        self.root = variable.lookups[0]
+
+    def resolve(self, context):
+        try:
+            root = context[self.root]
+        except KeyError:
+            # let the variable fail as it would have
+            return self.variable.resolve(context)
+        render_context = context.render_context
+        memo = render_context.get(MEMO_KEY)
+        if memo is None:
+            memo = render_context[MEMO_KEY] = {}
+        key = (self.var, id(root))
+        try:
+            return memo[key][1]
+        except KeyError:
+            pass
+        value = self.variable.resolve(context)
+        # keep the root alive with the value, so its id can't be
+        # reused by another object during the render.
+        memo[key] = (root, value)
+        return value
+
+
+def memoized(argument):
+    """ return a MemoizedVariable for argument if it is a
+    dotted template variable, or argument itself otherwise.
+    """
+    if isinstance(argument, Variable) and argument.lookups is not None and (
+            len(argument.lookups) > 1):
+        return MemoizedVariable(argument)
+    return argument
@@ -0,0 +1,185 @@
+""" optimize.py, part of django-macros, holds the passes run
+over a macro's nodelist once, when the macro is compiled, to
+make each call to it cheaper to render.
+"""
+
+import re
+
+from django.template.base import TextNode, VariableNode
+from django.template.defaulttags import CommentNode, LoadNode
+from django.utils.safestring import mark_safe
+
+
+# tags whose content is whitespace sensitive.
+PRESERVE_TAG_RE = re.compile(
+    r'<(/?)(pre|textarea|script|style)\b[^>]*>', re.IGNORECASE)
+# whitespace between html tags.
+BETWEEN_TAGS_RE = re.compile(r'>\s+<')
+# whitespace at the edges of a node's text, where it is next
+# to a template tag.
+EDGE_RE = re.compile(r'^\s+|\s+$')
+
+
+def _collapse(text):
+    """ remove whitespace between html tags, and collapse
+    whitespace next to template tags to a single space.
+    """
+    text = BETWEEN_TAGS_RE.sub('><', text)
+    return EDGE_RE.sub(' ', text)
+
+
+def strip_whitespace(nodelist):
+    """ collapse insignificant whitespace in the text of
+    nodelist (and the nodelists inside it), in place.
+
+    Whitespace between html tags is removed, as by django's
+    {% spaceless %} tag, and whitespace next to template tags
+    (e.g. the indentation around {% for %}) is collapsed to a
+    single space. Other whitespace, and the content of <pre>,
+    <textarea>, <script> and <style> elements, is left as it is.
+    """
+    preserving = 0
+    for node in nodelist.get_nodes_by_type(TextNode):
+        parts = []
+        # text not in a preserved element, collapsed as one
+        # so that whitespace around their tags is seen.
+        pending = ''
+        position = 0
+        for match in PRESERVE_TAG_RE.finditer(node.s):
+            text = node.s[position:match.start()]
+            position = match.end()
+            if preserving:
+                parts.append(text)
+            else:
+                pending += text
+            if match.group(1):
+                preserving = max(preserving - 1, 0)
+                if preserving:
+                    parts.append(match.group(0))
+                else:
+                    pending = match.group(0)
+            else:
+                if preserving:
+                    parts.append(match.group(0))
+                else:
+                    parts.append(_collapse(pending + match.group(0)))
+                    pending = ''
+                preserving += 1
+        text = node.s[position:]
+        if preserving:
+            parts.append(text)
+        else:
+            parts.append(_collapse(pending + text))
+        node.s = ''.join(parts)
+
+
+# nodes which output nothing and have no effect when rendered.
+NO_OUTPUT_NODES = (CommentNode, LoadNode)
+
+
+def flatten(nodelist):
+    """ drop the nodes in nodelist that output nothing, and
+    merge the runs of static text left, e.g. by {# comments #},
+    into single TextNodes, in place.
+    """
+    nodes = []
+    for node in nodelist:
+        if isinstance(node, NO_OUTPUT_NODES):
+            continue
+        if isinstance(node, TextNode):
+            if not node.s:
+                continue
+            if nodes and type(nodes[-1]) is TextNode and (
+                    type(node) is TextNode):
+                # merge into a new node, as the previous one
+                # may be shared, e.g. with a {% loadmacros %}
+                # sheet's nodelist.
+                merged = TextNode(nodes[-1].s + node.s)
+                merged.token = getattr(nodes[-1], 'token', None)
+                merged.origin = getattr(nodes[-1], 'origin', None)
+                nodes[-1] = merged
+                continue
+        nodes.append(node)
+    nodelist[:] = nodes
+    if hasattr(nodelist, 'contains_nontext'):
+        nodelist.contains_nontext = any(
+            not isinstance(node, TextNode) for node in nodes)
+    return nodelist
+
+
+def compile_parts(nodelist):
+    """ lower nodelist, if it holds only static text and
+    {{ variables }}, to a tuple of its static parts and a tuple
+    of the VariableNodes between them, for render_parts.
+    Return None for any other nodelist.
+    """
+    static = ['']
+    slots = []
+    for node in nodelist:
+        if type(node) is TextNode:
+            static[-1] += node.s
+        elif type(node) is VariableNode:
+            slots.append(node)
+            static.append('')
+        else:
+            return None
+    return tuple(static), tuple(slots)
+
+
+def render_parts(parts, context):
+    """ render the parts from compile_parts in context, with
+    a single join, as rendering their nodelist would.
+    """
+    static, slots = parts
+    bits = [static[0]]
+    append = bits.append
+    node = None
+    try:
+        for node, text in zip(slots, static[1:]):
+            # the render method of the variable itself, which
+            # does the same escaping and localization as in
+            # the nodelist.
+            append(node.render(context))
+            append(text)
+    except Exception as e:
+        _annotate(e, node, context)
+        raise
+    return mark_safe(''.join(bits))
+
+
+def encode_parts(parts):
+    """ return the static parts from compile_parts encoded as
+    utf-8, for render_parts_bytes, or None if parts is None.
+    """
+    if parts is None:
+        return None
+    return tuple(text.encode('utf-8') for text in parts[0])
+
+
+def render_parts_bytes(parts, encoded, context, out):
+    """ render the parts from compile_parts in context into
+    out, a bytearray, as utf-8, writing the static parts
+    encoded by encode_parts as they are.
+    """
+    static, slots = parts
+    out += encoded[0]
+    node = None
+    try:
+        for node, text in zip(slots, encoded[1:]):
+            out += node.render(context).encode('utf-8')
+            out += text
+    except Exception as e:
+        _annotate(e, node, context)
+        raise
+
+
+def _annotate(e, node, context):
+    # annotate the error with its place in the template,
+    # as Node.render_annotated does.
+    template = getattr(context, 'template', None)
+    if (node is not None and template is not None and
+            template.engine.debug and
+            not hasattr(e, 'template_debug')):
+        e.template_debug = (
+            context.render_context.template.get_exception_info(
+                e, node.token))
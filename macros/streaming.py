@@ -0,0 +1,183 @@
+""" streaming.py, part of django-macros, renders templates
+using macros as an iterator of chunks, so that a page made of
+many macro calls can start reaching the client before all of it
+has rendered.
+
+Macro nodes (and the nodelists inside them) are rendered through
+their iter_render method, and yield their output as it is
+produced; the output of other nodes between macro calls is
+buffered and yielded along with it.
+
+Templates using the {% flush %} tag (at their top level or in
+macros) are instead sent in exactly one chunk per flush, and
+the time taken to render each chunk is recorded for the
+Server-Timing header. Flush tags only take effect where they are
+streamed: a flush tag rendered any other way while streaming,
+e.g. in a macro called inside an {% if %}, raises rather than
+being ignored.
+"""
+
+import time
+from itertools import chain
+
+from django.http import StreamingHttpResponse
+from django.template.loader import get_template
+
+try:
+    from django.template.context import make_context
+except ImportError:
+    # Django < 1.8
+    make_context = None
+
+try:
+    from django.utils.encoding import force_text
+except ImportError:
+    # Django >= 4.0
+    from django.utils.encoding import force_str as force_text
+
+
+class Flush(object):
+    """ yielded by a {% flush %} tag's iter_render, marking
+    the end of a chunk.
+    """
+
+    def __init__(self, name=None):
+        self.name = name
+
+
+def render_node(node, context):
+    """ render a single node, as NodeList.render does. """
+    try:
+        render = node.render_annotated
+    except AttributeError:
+        # Django < 1.9, or not a Node
+        render = getattr(node, 'render', None)
+        if render is None:
+            return force_text(node)
+    return force_text(render(context))
+
+
+def iter_nodelist(nodelist, context):
+    """ render nodelist, yielding its output in chunks that
+    end wherever a node able to stream its output starts.
+    """
+    buffered = []
+    for node in nodelist:
+        iter_render = getattr(node, 'iter_render', None)
+        if iter_render is None:
+            buffered.append(render_node(node, context))
+            continue
+        if buffered:
+            yield ''.join(buffered)
+            buffered = []
+        for chunk in iter_render(context):
+            yield chunk
+    if buffered:
+        yield ''.join(buffered)
+
+
+def stream_template(template, context, timings=None):
+    """ render template (a django.template.Template) in
+    context as an iterator of chunks.
+
+    If the template contains {% flush %} tags, a chunk is
+    yielded at each of them, and at the end, and nowhere else.
+    (name, seconds) pairs giving how long each chunk took to
+    render are then appended to timings, if it is given.
+    """
+    # circular import
+    from .templatetags.macros import FlushNode
+    if not template.nodelist.get_nodes_by_type(FlushNode):
+        chunks = _stream(template, context)
+        return (chunk for chunk in chunks if not isinstance(chunk, Flush))
+    return _coalesce(_stream_flushes(template, context), timings)
+
+
+def _stream_flushes(template, context):
+    # mark the context, so that flush tags rendered without
+    # being streamed raise.
+    context.streaming_flushes = True
+    try:
+        for chunk in _stream(template, context):
+            yield chunk
+    finally:
+        context.streaming_flushes = False
+
+
+def _coalesce(chunks, timings):
+    buffered = []
+    started = time.time()
+    for chunk in chunks:
+        if not isinstance(chunk, Flush):
+            buffered.append(chunk)
+            continue
+        if timings is not None:
+            timings.append((chunk.name or 'flush{0}'.format(len(timings) + 1),
+                            time.time() - started))
+        yield ''.join(buffered)
+        buffered = []
+        started = time.time()
+    if buffered:
+        yield ''.join(buffered)
+
+
+def _stream(template, context):
+    render_context = context.render_context
+    if hasattr(render_context, 'push_state'):
+        # Django 1.11+
+        with render_context.push_state(template):
+            for chunk in _stream_bound(template, context):
+                yield chunk
+    else:
+        for chunk in _stream_bound(template, context):
+            yield chunk
+
+
+def _stream_bound(template, context):
+    if getattr(context, 'template', False) is None:
+        with context.bind_template(template):
+            context.template_name = template.name
+            for chunk in iter_nodelist(template.nodelist, context):
+                yield chunk
+    else:
+        for chunk in iter_nodelist(template.nodelist, context):
+            yield chunk
+
+
+def format_server_timing(timings):
+    """ format (name, seconds) timings as the value of a
+    Server-Timing header.
+    """
+    return ', '.join('{0};dur={1:.1f}'.format(name, seconds * 1000)
+                     for name, seconds in timings)
+
+
+def streaming_response(request, template_name, context=None, **kwargs):
+    """ return a StreamingHttpResponse of template_name
+    rendered with context for request. Further keyword
+    arguments (content_type, status, ...) are passed to the
+    response.
+
+    The first chunk is rendered before the response is
+    returned, so that for templates using {% flush %}, the
+    time taken to render it can be sent in the Server-Timing
+    header. The timings of all the chunks are also collected
+    as they render in the response's server_timing list.
+    """
+    t = get_template(template_name)
+    t = getattr(t, 'template', t)
+    if make_context is not None:
+        context = make_context(context, request)
+    else:
+        from django.template import RequestContext
+        context = RequestContext(request, context)
+    timings = []
+    chunks = stream_template(t, context, timings)
+    first = next(chunks, None)
+    if first is not None:
+        chunks = chain([first], chunks)
+    response = StreamingHttpResponse(chunks, **kwargs)
+    if timings:
+        response['Server-Timing'] = format_server_timing(timings)
+    response.server_timing = timings
+    return response
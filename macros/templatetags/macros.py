@@ -13,10 +13,51 @@
 macros within django templates.
 """
 
+import hashlib
+import uuid
+from copy import copy
 from re import match as regex_match
 from django import template
+from django.conf import settings
+from django.template.base import FilterExpression
+from django.template.loader_tags import IncludeNode
 from django.template.loader import get_template
 
+from .. import cache as macro_cache
+from .. import deferred
+from .. import holes
+from .. import lookups
+from .. import optimize
+from .. import streaming
+from .. import writer
+
+try:
+    from django.utils.encoding import force_text
+except ImportError:
+    # Django >= 4.0
+    from django.utils.encoding import force_str as force_text
+
+try:
+    string_types = basestring
+except NameError:
+    # Python 3
+    string_types = str
+
+try:
+    from inspect import isawaitable
+except ImportError:
+    # Python < 3.5 has no awaitables
+    def isawaitable(value):
+        return False
+
+
+def asyncrender():
+    """ import the asyncrender module on first use, as it
+    needs Python 3.5+ and asgiref.
+    """
+    from .. import asyncrender
+    return asyncrender
+
 register = template.Library()
 
 
@@ -39,13 +80,56 @@ class DefineMacroNode(template.Node):
     defines a macro.
     """
 
-    def __init__(self, name, nodelist, args, kwargs):
+    def __init__(self, name, nodelist, args, kwargs, recursive=False):
         # the values in the kwargs dictionary are by
         # assumption instances of template.Variable.
         self.name = name
         self.nodelist = nodelist
         self.args = args
         self.kwargs = kwargs
+        # whether the macro's body may call it, in which
+        # case its calls are limited in depth.
+        self.recursive = recursive
+        self.compile_body()
+        # an id for the definition, unique to this process.
+        self.definition_id = uuid.uuid4().hex
+
+    def compile_body(self):
+        """ work out what the macro's renders need to know of its
+        body, once the body has been parsed.
+        """
+        # the body lowered to static text and variable slots,
+        # if it holds nothing else, for rendering it with one
+        # join (see optimize.compile_parts), and the static text
+        # encoded for rendering to bytes.
+        self.parts = optimize.compile_parts(self.nodelist)
+        self.encoded_parts = optimize.encode_parts(self.parts)
+        # whether the body calls macros directly, which then
+        # write into the body's output (see writer.py).
+        self.writes_into = writer.writes_into(self.nodelist)
+
+    def cache_name(self):
+        """ the name the macro's fragments are cached under. Macro
+        names are only unique within a template, so it is keyed on
+        the template's name and the macro's position there, or for
+        a template not loaded by name, on an id given to the
+        definition in this process.
+        """
+        try:
+            return self._cache_name
+        except AttributeError:
+            pass
+        template_name = getattr(
+            getattr(self, 'origin', None), 'template_name', None)
+        position = getattr(getattr(self, 'token', None), 'position', None)
+        if template_name is not None and position is not None:
+            definition = u'{0}:{1}'.format(template_name, position[0])
+        else:
+            definition = self.definition_id
+        self._cache_name = '{0}.{1}'.format(
+            self.name,
+            hashlib.md5(definition.encode('utf-8')).hexdigest())
+        return self._cache_name
 
     def render(self, context):
         # convert template variable defaults into resolved
@@ -59,6 +143,63 @@ class DefineMacroNode(template.Node):
         return ''
 
 
+def _names_used(nodelist, included=None):
+    """ return the set of names the variables in nodelist (and
+    the nodelists inside it, and the templates they include)
+    start with, as far as they can be found on its nodes. The
+    set holds None if nodelist includes a template that can't
+    be known until it renders.
+    """
+    names = set()
+    if included is None:
+        included = set()
+
+    def visit(value, depth):
+        if isinstance(value, FilterExpression):
+            visit(value.var, depth)
+            for func, filter_args in value.filters:
+                for lookup, arg in filter_args:
+                    visit(arg, depth)
+        elif isinstance(value, template.Variable):
+            if value.lookups:
+                names.add(value.lookups[0])
+        elif isinstance(value, (list, tuple)):
+            for item in value:
+                visit(item, depth)
+        elif isinstance(value, dict):
+            for item in value.values():
+                visit(item, depth)
+        elif depth and hasattr(value, '__dict__') and not isinstance(
+                value, (template.Node, template.NodeList)):
+            # e.g. the conditions of an {% if %} tag.
+            for item in vars(value).values():
+                visit(item, depth - 1)
+
+    for node in nodelist.get_nodes_by_type(template.Node):
+        for value in vars(node).values():
+            visit(value, 3)
+        if isinstance(node, IncludeNode) and not node.isolated_context:
+            names.update(_included_names(node, included))
+    return names
+
+
+def _included_names(node, included):
+    """ return _names_used for the template an {% include %}
+    tag includes, if it is named by a constant.
+    """
+    name = node.template.var
+    if not isinstance(name, string_types) or node.template.filters:
+        return set([None])
+    if name in included:
+        return set()
+    included.add(name)
+    try:
+        t = get_template(name)
+    except (template.TemplateDoesNotExist, template.TemplateSyntaxError):
+        return set([None])
+    return _names_used(getattr(t, 'template', t).nodelist, included)
+
+
 @register.tag(name="macro")
 def do_macro(parser, token):
     """ the function taking the parsed tag and returning
@@ -92,6 +233,15 @@ def do_macro(parser, token):
         r'^([A-Za-z_][\w_]*)=(".*"|{0}.*{0}|[A-Za-z_][\w_]*)$'.format("'"))
     # leave further validation to the template variable class
 
+    # trailing flags: "strip" asks for the macro's whitespace
+    # to be collapsed, and "recursive" lets its body call it.
+    flags = set()
+    while arguments and arguments[-1] in ('strip', 'recursive'):
+        flags.add(arguments[-1])
+        arguments = arguments[:-1]
+    strip = 'strip' in flags or getattr(
+        settings, 'MACROS_STRIP_WHITESPACE', False)
+
     args = []
     kwargs = {}
     for argument in arguments:
@@ -103,7 +253,7 @@ def do_macro(parser, token):
             kwarg_match = regex_match(
                 kwarg_regex, argument)
             if kwarg_match:
-                kwargs[kwarg_match.groups()[0]] = template.Variable(
+                kwargs[kwarg_match.groups()[0]] = lookups.interned(
                     # convert to a template variable here
                     kwarg_match.groups()[1])
             else:
@@ -111,13 +261,50 @@ def do_macro(parser, token):
                     "Malformed arguments to the {0} tag.".format(
                         tag_name))
 
+    _setup_macros_dict(parser)
+    if 'recursive' in flags:
+        # store the macro before its body is parsed, so that
+        # the body can call it; the body is filled in below.
+        parser._macros[macro_name] = DefineMacroNode(
+            macro_name, template.NodeList(), args, kwargs, recursive=True)
+
     # parse to the endmacro tag and get the contents
     nodelist = parser.parse(('endmacro',))
     parser.delete_first_token()
+    if flags:
+        # before the flags, a trailing "strip" or "recursive" was
+        # an argument; rather than reinterpret a macro using it as
+        # one, ask for it to be renamed.
+        used = _names_used(nodelist)
+        clashes = flags & used
+        if clashes:
+            raise template.TemplateSyntaxError(
+                "'{0}' at the end of the {1} tag is a flag, but the "
+                "body of macro '{2}' uses a variable named {0}; rename "
+                "the argument.".format(min(clashes), tag_name, macro_name))
+        if None in used:
+            raise template.TemplateSyntaxError(
+                "'{0}' at the end of the {1} tag is a flag, but the "
+                "body of macro '{2}' includes a template that may use "
+                "a variable named {0}; include it by name, or with "
+                "only.".format(min(flags), tag_name, macro_name))
+    # drop nodes with no output, and merge the static text
+    # around them.
+    optimize.flatten(nodelist)
+    if strip:
+        optimize.strip_whitespace(nodelist)
+    # give the body's variables inline lookup caches.
+    lookups.cache_lookups(nodelist)
+    # encode the macro's static text once, for rendering
+    # to bytes.
+    writer.encode_text_nodes(nodelist)
 
-    # store macro in parser._macros, creating attribute
-    # if necessary
-    _setup_macros_dict(parser)
+    if 'recursive' in flags:
+        macro = parser._macros[macro_name]
+        macro.nodelist = nodelist
+        macro.compile_body()
+        return macro
+    # store macro in parser._macros
     parser._macros[macro_name] = DefineMacroNode(
         macro_name, nodelist, args, kwargs)
     return parser._macros[macro_name]
@@ -131,6 +318,14 @@ class LoadMacrosNode(template.Node):
     def __init__(self, macros):
         self.macros = macros
 
+    def get_nodes_by_type(self, nodetype):
+        # include the loaded macros, e.g. so that their flush
+        # tags are found.
+        nodes = super(LoadMacrosNode, self).get_nodes_by_type(nodetype)
+        for macro in self.macros:
+            nodes.extend(macro.get_nodes_by_type(nodetype))
+        return nodes
+
     def render(self, context):
         # render all macro definitions in the current
         # context to set their template variable default
@@ -184,43 +379,469 @@ class UseMacroNode(template.Node):
     uses a macro.
     """
 
-    def __init__(self, macro, args, kwargs):
+    def __init__(self, macro, args, kwargs, options=None):
         # all the values kwargs and the items in args
-        # are by assumption template.Variable instances.
+        # are by assumption template.Variable instances, or
+        # FilterExpressions for arguments with filters.
         self.macro = macro
         self.args = args
         self.kwargs = kwargs
+        # call site options (see _pop_macro_options), keyed
+        # by option name.
+        self.options = options or {}
+
+    def get_bindings(self, context):
+        """ resolve the call's arguments against the macro's
+        signature, returning a list of (name, value) pairs in
+        the order they are bound. As each argument is bound, the
+        arguments after it can see it, e.g. a macro_kwarg whose
+        default names an earlier argument.
+        """
+        bindings = _Bindings()
+        # pushed as it is filled, and again by bind.
+        bound = bindings.values = {}
+        context.dicts.append(bound)
+        try:
+            # bind all of the use_macros args
+            for i, arg in enumerate(self.macro.args):
+                try:
+                    template_variable = self.args[i]
+                    bound[arg] = template_variable.resolve(context)
+                except IndexError:
+                    bound[arg] = ""
+                bindings.append((arg, bound[arg]))
+
+            # bind all of use_macros kwargs
+            for name, default in self.macro.kwargs.items():
+                if name in self.kwargs:
+                    bound[name] = self.kwargs[name].resolve(context)
+                else:
+                    if isinstance(default, template.Variable):
+                        # variables must be resolved explicitly,
+                        # because otherwise if macro's loaded from
+                        # a separate file things will break
+                        bound[name] = default.resolve(context)
+                    else:
+                        bound[name] = default
+                bindings.append((name, bound[name]))
+        finally:
+            context.dicts.pop()
+
+        return bindings
+
+    def resolve_bindings(self, context):
+        """ get_bindings, with any awaitable values replaced
+        by their results when rendering from async code (see
+        asyncrender.py).
+        """
+        bindings = self.get_bindings(context)
+        if getattr(context, 'rendering_async', False) and any(
+                isawaitable(value) for name, value in bindings):
+            bindings = asyncrender().resolve_awaitables_sync(bindings)
+        return bindings
+
+    def bind(self, context, bindings):
+        """ return the context for the macro's body to render
+        in, with bindings pushed onto it as a single dict. The
+        caller unbinds it once the body has rendered, so that the
+        bindings don't leak into the rest of the template.
+
+        Calls marked only render in a new context holding
+        nothing but the bindings, as the include tag's only does.
+        """
+        if self.macro.recursive:
+            _enter_recursion(context, self.macro)
+        # the dict get_bindings filled, unless the bindings were
+        # changed since, e.g. by awaiting their values.
+        values = getattr(bindings, 'values', None)
+        if values is None:
+            values = dict(bindings)
+        if 'only' in self.options:
+            return _new_context(context, values)
+        context.dicts.append(values)
+        return context
+
+    def unbind(self, context):
+        """ pop the bindings pushed by bind off context. """
+        if 'only' not in self.options:
+            context.pop()
+        if self.macro.recursive:
+            _leave_recursion(context, self.macro)
+
+    def render_macro(self, context, bindings):
+        """ render the macro's body with bindings pushed
+        onto the context.
+        """
+        body_context = self.bind(context, bindings)
+        try:
+            if self.macro.parts is not None:
+                return optimize.render_parts(self.macro.parts, body_context)
+
+            # return the nodelist rendered in the adjusted context,
+            # through a writer if it calls macros, so that they
+            # write straight into this call's output.
+            if self.macro.writes_into:
+                return writer.render_nodelist(
+                    self.macro.nodelist, body_context)
+            return self.macro.nodelist.render(body_context)
+        finally:
+            self.unbind(context)
+
+    @property
+    def renders_whole(self):
+        """ whether the call's options (caching, deferring...)
+        need its output as a whole, so that it can't be
+        streamed or written piecemeal.
+        """
+        return any(name in self.options
+                   for name in ('dynamic', 'deferred', 'cache', 'reuse'))
 
     def render(self, context):
+        return self.render_bound(context, self.resolve_bindings(context))
+
+    def render_async(self, context):
+        """ the coroutine rendering this node from async code,
+        awaiting its awaitable arguments concurrently.
+        """
+        return asyncrender().render_node(self, context)
+
+    def iter_render(self, context):
+        """ render the call as an iterator of chunks, streaming
+        the macro's body where the call's options allow.
+        """
+        bindings = self.resolve_bindings(context)
+        if self.renders_whole:
+            yield self.render_bound(context, bindings)
+            return
+        body_context = self.bind(context, bindings)
+        try:
+            if self.macro.parts is not None:
+                yield optimize.render_parts(self.macro.parts, body_context)
+                return
+            for chunk in streaming.iter_nodelist(
+                    self.macro.nodelist, body_context):
+                yield chunk
+        finally:
+            self.unbind(context)
 
-        # add all of the use_macros args into context
-        for i, arg in enumerate(self.macro.args):
-            try:
-                template_variable = self.args[i]
-                context[arg] = template_variable.resolve(context)
-            except IndexError:
-                context[arg] = ""
-
-        # add all of use_macros kwargs into context
-        for name, default in self.macro.kwargs.items():
-            if name in self.kwargs:
-                context[name] = self.kwargs[name].resolve(context)
+    def render_to(self, context, write):
+        """ render the call into write, writing the macro's
+        body straight into it where the call's options allow.
+        """
+        bindings = self.resolve_bindings(context)
+        if self.renders_whole:
+            write(self.render_bound(context, bindings))
+            return
+        body_context = self.bind(context, bindings)
+        try:
+            if self.macro.parts is not None:
+                write(optimize.render_parts(self.macro.parts, body_context))
+                return
+            if self.macro.writes_into:
+                writer.write_nodelist(
+                    self.macro.nodelist, body_context, write)
             else:
-                if isinstance(default, template.Variable):
-                    # variables must be resolved explicitly,
-                    # because otherwise if macro's loaded from
-                    # a separate file things will break
-                    context[name] = default.resolve(context)
-                else:
-                    context[name] = default
+                write(self.macro.nodelist.render(body_context))
+        finally:
+            self.unbind(context)
+
+    def render_bytes_to(self, context, out):
+        """ render the call into out, a bytearray, as utf-8,
+        using the macro body's pre-encoded static text.
+        """
+        bindings = self.resolve_bindings(context)
+        if self.renders_whole:
+            out += self.render_bound(context, bindings).encode('utf-8')
+            return
+        body_context = self.bind(context, bindings)
+        try:
+            if self.macro.parts is not None:
+                optimize.render_parts_bytes(
+                    self.macro.parts, self.macro.encoded_parts,
+                    body_context, out)
+                return
+            writer.write_nodelist_bytes(
+                self.macro.nodelist, body_context, out)
+        finally:
+            self.unbind(context)
+
+    def render_bound(self, context, bindings):
+        """ render the call with its arguments already bound,
+        honouring the call's options.
+        """
+        if 'dynamic' in self.options and getattr(
+                context, 'render_holes', False):
+            return holes.placeholder(self.macro, bindings)
+        if 'deferred' in self.options:
+            deferred_renders = getattr(context, 'deferred_renders', None)
+            if deferred_renders is not None:
+                return deferred_renders.defer(
+                    self.snapshot(context, bindings))
+        if 'reuse' in self.options:
+            return self.render_reused(context, bindings)
+        if 'cache' in self.options:
+            return self.render_cached(context, bindings)
+        return self.render_macro(context, bindings)
+
+    def render_reused(self, context, bindings):
+        """ render the macro once per render for each set of
+        argument values, e.g. for subtrees shared between the
+        branches of a recursive macro, keyed on the identity of
+        the values.
+        """
+        outputs = context.render_context.get(REUSE_KEY)
+        if outputs is None:
+            outputs = context.render_context[REUSE_KEY] = {}
+        key = (id(self.macro),) + tuple(id(value) for name, value in bindings)
+        try:
+            return outputs[key][1]
+        except KeyError:
+            pass
+        if 'cache' in self.options:
+            output = self.render_cached(context, bindings)
+        else:
+            output = self.render_macro(context, bindings)
+        # keep the values alive with the output, so their ids
+        # can't be reused by other objects during the render.
+        outputs[key] = (bindings, output)
+        return output
+
+    def render_cached(self, context, bindings):
+        """ render the macro through the fragment cache, keyed
+        on the macro's definition, the bound argument values,
+        and the current generation of each of the call's tags.
+        """
+        timeout = self._resolve_seconds('cache', context)
+        stale = 0
+        if 'stale' in self.options:
+            stale = self._resolve_seconds('stale', context) or 0
+        tags = ()
+        if 'tags' in self.options:
+            tags = macro_cache.parse_tags(
+                self.options['tags'].render(context))
+
+        name = self.macro.cache_name()
+        if getattr(context, 'render_holes', False):
+            # fragments rendered for a skeleton hold placeholders
+            # for the dynamic calls in them, so keep them apart
+            # from those of normal renders.
+            name += ':holes'
+        key = macro_cache.make_fragment_key(
+            name,
+            [force_text(name) + '=' + force_text(value)
+             for name, value in bindings],
+            tags)
+        def render():
+            # the fragment will outlive this render, so it
+            # mustn't contain placeholders for deferred calls.
+            with deferred.suspended(context):
+                return self.render_macro(context, bindings)
+
+        return macro_cache.get_or_render(
+            key, render, timeout, stale,
+            lambda: self.snapshot(context, bindings))
+
+    def snapshot(self, context, bindings):
+        """ return a function rendering the macro, with the
+        already resolved bindings, in a copy of the context, so
+        that it can be called later from another thread.
+
+        The copy has its own copies of the context's dicts, as
+        they are when the call is made, and its own render context
+        state, so that calls rendering at the same time don't share
+        tag state (cycles, recursion depths...). The values in the
+        context are still shared, and must be safe to read from
+        several threads.
+        """
+        context = copy(context)
+        # tags such as {% for %} change their dicts in place as
+        # the template renders on, so copy them as they are now.
+        context.dicts = [_snapshot_dict(values) for values in context.dicts]
+        # calls inside the macro can't be deferred, since by the
+        # time it renders the deferred calls may have been spliced.
+        context.deferred_renders = None
+        render_context = context.render_context
+        depths = render_context.get(DEPTH_KEY)
+        render_context.push()
+        if depths:
+            # carry on the depths of the recursive calls the
+            # call was made from, in a dict of its own.
+            render_context[DEPTH_KEY] = dict(depths)
+        bindings = list(bindings)
+        return lambda: self.render_macro(context, bindings)
+
+    def _resolve_seconds(self, option, context):
+        """ resolve a cache duration option to an int, or
+        None for no expiry.
+        """
+        seconds = self.options[option].resolve(context)
+        if seconds is None:
+            return None
+        try:
+            return int(seconds)
+        except (ValueError, TypeError):
+            raise template.TemplateSyntaxError(
+                "use_macro got a non-integer {0} value: "
+                "{1!r}".format(option, seconds))
+
+
+def _snapshot_dict(values):
+    """ copy a dict of a context, and the {% for %} loop state in
+    it, which the for tag updates in place on each pass.
+    """
+    values = dict(values)
+    if 'forloop' in values:
+        values['forloop'] = _snapshot_forloop(values['forloop'])
+    return values
+
+
+def _snapshot_forloop(forloop):
+    if not isinstance(forloop, dict):
+        return forloop
+    forloop = dict(forloop)
+    if forloop.get('parentloop'):
+        forloop['parentloop'] = _snapshot_forloop(forloop['parentloop'])
+    return forloop
+
+
+class _OptionTemplate(object):
+    """ wraps a compiled template so that an option
+    whose string value contains template syntax, e.g.
+    tags="product:{{ p.pk }}", is rendered in the calling
+    context.
+    """
+
+    def __init__(self, variable):
+        self.variable = variable
+        literal = getattr(variable, 'literal', None)
+        if isinstance(literal, string_types) and '{' in literal:
+            self.template = template.Template(literal)
+        else:
+            self.template = None
+
+    def render(self, context):
+        if self.template is not None:
+            return self.template.render(context)
+        return self.variable.resolve(context)
+
+
+# keyword options accepted by use_macro and macro_block
+# in addition to the macro's own arguments. An option is
+# only taken as such if the macro doesn't define a keyword
+# argument with the same name.
+MACRO_OPTIONS = ('cache', 'tags', 'stale')
+# flags which, like the include tag's "only", may follow the
+# arguments to use_macro and macro_block. A flag is only taken
+# as such if it follows all of the macro's positional arguments.
+MACRO_FLAGS = ('dynamic', 'deferred', 'only', 'memo', 'reuse')
+
+# the maximum depth calls to a recursive macro may nest to.
+MACROS_MAX_RECURSION_DEPTH = 32
+
+# render_context keys of the depth of each recursive macro's
+# calls, and of the outputs of calls marked reuse.
+DEPTH_KEY = 'macros.depth'
+REUSE_KEY = 'macros.reuse'
+
 
-        # return the nodelist rendered in the adjusted context
-        return self.macro.nodelist.render(context)
+def _enter_recursion(context, macro):
+    """ count a call to the recursive macro, raising if the
+    calls nest too deep.
+    """
+    depths = context.render_context.get(DEPTH_KEY)
+    if depths is None:
+        depths = context.render_context[DEPTH_KEY] = {}
+    depth = depths.get(macro, 0) + 1
+    limit = getattr(settings, 'MACROS_MAX_RECURSION_DEPTH',
+                    MACROS_MAX_RECURSION_DEPTH)
+    if depth > limit:
+        raise template.TemplateSyntaxError(
+            "Macro '{0}' exceeded the maximum recursion depth "
+            "of {1}".format(macro.name, limit))
+    depths[macro] = depth
+
+
+def _leave_recursion(context, macro):
+    depths = context.render_context.get(DEPTH_KEY)
+    if depths:
+        depths[macro] -= 1
+
+
+class _Bindings(list):
+    """ the (name, value) pairs bound by a macro call, with
+    values, the dict of them pushed onto the context.
+    """
+    values = None
+
+
+def _new_context(context, values):
+    """ return a context like context (autoescaping, template,
+    render context...), but holding only values.
+    """
+    try:
+        return context.new(values)
+    except AttributeError:
+        # Django < 1.7
+        return template.Context(values, autoescape=context.autoescape)
+
+
+def _pop_macro_options(macro, args, kwargs, tag_name, block_args=0):
+    """ remove call site options from kwargs, and flags from
+    the end of args, returning them as a dictionary (with a
+    value of True for each flag given). block_args is the
+    number of positional arguments given by macro_arg tags.
+    """
+    options = {}
+    while (args and len(args) + block_args > len(macro.args) and
+           isinstance(args[-1], template.Variable) and
+           args[-1].literal is None and args[-1].var in MACRO_FLAGS):
+        options[args.pop().var] = True
+    for name in MACRO_OPTIONS:
+        if name in kwargs and name not in macro.kwargs:
+            options[name] = kwargs.pop(name)
+    for name in ('tags', 'stale'):
+        if name in options and 'cache' not in options:
+            raise template.TemplateSyntaxError(
+                "{0} tag was given {1} without a cache "
+                "timeout.".format(tag_name, name))
+    if 'tags' in options:
+        options['tags'] = _OptionTemplate(options['tags'])
+    if 'memo' in options:
+        # memoize the call's dotted arguments for the render.
+        args[:] = [lookups.memoized(arg) for arg in args]
+        for name, value in kwargs.items():
+            kwargs[name] = lookups.memoized(value)
+    return options
+
+
+# a call site argument with filters, e.g. price|floatformat:2,
+# compiled to a FilterExpression.
+FILTERED_ARGUMENT_REGEX = r'^(?:".*?"|{0}.*?{0}|[\w.]+)\|.+$'.format("'")
 
 
-def parse_macro_params(token):
+def _compile_argument(value, parser=None):
+    """ compile a call site argument to something with a
+    resolve(context) method: a FilterExpression if it has filters
+    (and a parser to compile them with), and a template variable
+    otherwise.
+    """
+    if parser is not None and regex_match(FILTERED_ARGUMENT_REGEX, value):
+        expression = parser.compile_filter(value)
+        if isinstance(expression.var, template.Variable):
+            expression.var = lookups.cached(expression.var)
+        return expression
+    # convert to a template variable here, with an inline
+    # cache for its lookups, sharing the parsed expression with
+    # every other argument with the same expression.
+    return lookups.interned(value)
+
+
+def parse_macro_params(token, parser=None):
     """
     Common parsing logic for both use_macro and macro_block
+
+    Given the parser, arguments may have filters, which are
+    compiled once here and applied as the arguments are bound.
     """
     try:
         bits = token.split_contents()
@@ -230,37 +851,45 @@ def parse_macro_params(token):
             "{0} tag requires at least one argument (macro name)".format(
                 token.contents.split()[0]))
 
+    args, kwargs = parse_macro_arguments(tag_name, values, parser)
+    return tag_name, macro_name, args, kwargs
+
+
+def parse_macro_arguments(tag_name, values, parser=None):
+    """ parse the argument bits of a macro call into a list of
+    args and a dictionary of kwargs.
+    """
     args = []
     kwargs = {}
 
     # leaving most validation up to the template.Variable
-    # class, but use regex here so that validation could
-    # be added in future if necessary.
-    kwarg_regex = (
-        r'^([A-Za-z_][\w_]*)=(".*"|{0}.*{0}|[A-Za-z_][\w_]*)$'.format(
-            "'"))
-    arg_regex = r'^([A-Za-z_][\w_]*|".*"|{0}.*{0}|(\d+))$'.format(
-        "'")
+    # class (or the parser, for filters), but use regex here so
+    # that validation could be added in future if necessary.
+    value_regex = r'".*"|{0}.*{0}|[A-Za-z_][\w_.]*|\d+'.format("'")
+    if parser is not None:
+        value_regex = r'(?:".*?"|{0}.*?{0}|[\w.]+)\|.+|'.format(
+            "'") + value_regex
+    kwarg_regex = r'^([A-Za-z_][\w_]*)=({0})$'.format(value_regex)
+    arg_regex = r'^({0})$'.format(value_regex)
     for value in values:
         # must check against the kwarg regex first
         # because the arg regex matches everything!
         kwarg_match = regex_match(
             kwarg_regex, value)
         if kwarg_match:
-            kwargs[kwarg_match.groups()[0]] = template.Variable(
-                # convert to a template variable here
-                kwarg_match.groups()[1])
+            kwargs[kwarg_match.groups()[0]] = _compile_argument(
+                kwarg_match.groups()[1], parser)
         else:
             arg_match = regex_match(
                 arg_regex, value)
             if arg_match:
-                args.append(template.Variable(arg_match.groups()[0]))
+                args.append(_compile_argument(arg_match.groups()[0], parser))
             else:
                 raise template.TemplateSyntaxError(
                     "Malformed arguments to the {0} tag.".format(
                         tag_name))
 
-    return tag_name, macro_name, args, kwargs
+    return args, kwargs
 
 
 @register.tag(name="use_macro")
@@ -268,15 +897,112 @@ def do_usemacro(parser, token):
     """ The function taking a parsed template tag
     and returning a UseMacroNode.
     """
-    tag_name, macro_name, args, kwargs = parse_macro_params(token)
+    tag_name, macro_name, args, kwargs = parse_macro_params(token, parser)
     try:
         macro = parser._macros[macro_name]
     except (AttributeError, KeyError):
         raise template.TemplateSyntaxError(
             "Macro '{0}' is not defined previously to the {1} tag".format(
                 macro_name, tag_name))
+    options = _pop_macro_options(macro, args, kwargs, tag_name)
     macro.parser = parser
-    return UseMacroNode(macro, args, kwargs)
+    return UseMacroNode(macro, args, kwargs, options)
+
+
+class UseMacroByNode(template.Node):
+    """ Template tag Node object for the tag which
+    uses a macro chosen by name as the template renders.
+    """
+
+    def __init__(self, tag_name, name, macros, args, kwargs, fallback=None):
+        # name is a FilterExpression giving the macro's name,
+        # and macros the dispatch table of the macros visible
+        # to the tag, keyed by name.
+        self.tag_name = tag_name
+        self.name = name
+        self.macros = macros
+        self.args = args
+        self.kwargs = kwargs
+        self.fallback = fallback
+        # the UseMacroNode for each macro called so far.
+        self.nodes = {}
+
+    def dispatch(self, context):
+        """ return the UseMacroNode calling the macro named
+        in context.
+        """
+        name = force_text(self.name.resolve(context))
+        try:
+            return self.nodes[name]
+        except KeyError:
+            pass
+        macro = self.macros.get(name)
+        if macro is None:
+            if self.fallback is None:
+                raise template.TemplateSyntaxError(
+                    "Macro '{0}' is not defined previously to the "
+                    "{1} tag, and it has no fallback".format(
+                        name, self.tag_name))
+            return self.fallback
+        # options are taken per macro, as with use_macro, so
+        # work on copies of the arguments.
+        args, kwargs = list(self.args), dict(self.kwargs)
+        options = _pop_macro_options(macro, args, kwargs, self.tag_name)
+        node = self.nodes[name] = UseMacroNode(macro, args, kwargs, options)
+        return node
+
+    def render(self, context):
+        return self.dispatch(context).render(context)
+
+    def render_async(self, context):
+        return self.dispatch(context).render_async(context)
+
+    def iter_render(self, context):
+        return self.dispatch(context).iter_render(context)
+
+    def render_to(self, context, write):
+        self.dispatch(context).render_to(context, write)
+
+    def render_bytes_to(self, context, out):
+        self.dispatch(context).render_bytes_to(context, out)
+
+
+@register.tag(name="use_macro_by")
+def do_usemacro_by(parser, token):
+    """ The function taking a parsed template tag
+    and returning a UseMacroByNode.
+    """
+    bits = token.split_contents()
+    if len(bits) < 2:
+        raise template.TemplateSyntaxError(
+            "{0} tag requires at least one argument (macro name)".format(
+                bits[0]))
+    tag_name, name, values = bits[0], bits[1], bits[2:]
+    _setup_macros_dict(parser)
+    # a trailing "else macro_name" names the macro called for
+    # names not in the dispatch table.
+    fallback_name = None
+    if len(values) >= 2 and values[-2] == 'else':
+        fallback_name = values[-1]
+        values = values[:-2]
+    args, kwargs = parse_macro_arguments(tag_name, values, parser)
+    fallback = None
+    if fallback_name is not None:
+        try:
+            macro = parser._macros[fallback_name]
+        except KeyError:
+            raise template.TemplateSyntaxError(
+                "Macro '{0}' is not defined previously to the {1} "
+                "tag".format(fallback_name, tag_name))
+        fallback_args, fallback_kwargs = list(args), dict(kwargs)
+        options = _pop_macro_options(
+            macro, fallback_args, fallback_kwargs, tag_name)
+        fallback = UseMacroNode(macro, fallback_args, fallback_kwargs, options)
+    # the macros visible to the tag are those defined (or
+    # loaded) before it.
+    return UseMacroByNode(
+        tag_name, parser.compile_filter(name), dict(parser._macros),
+        args, kwargs, fallback)
 
 
 class MacroBlockNode(UseMacroNode):
@@ -284,9 +1010,10 @@ class MacroBlockNode(UseMacroNode):
     syntax macro useage.
     """
 
-    def __init__(self, macro, nodelist, args, kwargs):
+    def __init__(self, macro, nodelist, args, kwargs, options=None):
         self.nodelist = nodelist
-        super(MacroBlockNode, self).__init__(macro, args, kwargs)
+        super(MacroBlockNode, self).__init__(
+            macro, args, kwargs, options)
 
 
 @register.tag(name="macro_block")
@@ -294,7 +1021,7 @@ def do_macro_block(parser, token):
     """ Function taking parsed template tag
     to a MacroBlockNode.
     """
-    tag_name, macro_name, args, kwargs = parse_macro_params(token)
+    tag_name, macro_name, args, kwargs = parse_macro_params(token, parser)
     # could add extra validation on the macro_name tag
     # here, but probably don't need to since we're checking
     # if there's a macro by that name anyway.
@@ -308,6 +1035,10 @@ def do_macro_block(parser, token):
     # get the arg and kwarg nodes from the nodelist
     nodelist = parser.parse(('endmacro_block',))
     parser.delete_first_token()
+    options = _pop_macro_options(
+        macro, args, kwargs, tag_name, block_args=len([
+            node for node in nodelist if isinstance(node, MacroArgNode) and
+            not isinstance(node, MacroKwargNode)]))
 
     # Loop through nodes, sorting into args/kwargs
     # (we could do this more semantically, but we loop
@@ -357,7 +1088,7 @@ def do_macro_block(parser, token):
                 tag_name))
 
     macro.parser = parser
-    return MacroBlockNode(macro, nodelist, args, kwargs)
+    return MacroBlockNode(macro, nodelist, args, kwargs, options)
 
 
 class MacroArgNode(template.Node):
@@ -388,6 +1119,7 @@ def do_macro_arg(parser, token):
     # need to split the token/do validation.
     nodelist = parser.parse(('endmacro_arg',))
     parser.delete_first_token()
+    optimize.flatten(nodelist)
     # simply save the contents to a MacroArgNode.
     return MacroArgNode(nodelist)
 
@@ -422,4 +1154,57 @@ def do_macro_kwarg(parser, token):
     # add some validation of the keyword argument here.
     nodelist = parser.parse(('endmacro_kwarg',))
     parser.delete_first_token()
+    optimize.flatten(nodelist)
     return MacroKwargNode(keyword, nodelist)
+
+
+class FlushNode(template.Node):
+    """ Template node object for the tag marking
+    where streamed output is flushed to the client.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def render(self, context):
+        if getattr(context, 'streaming_flushes', False):
+            # streaming, but through a tag (e.g. {% if %}, or a
+            # cached call) that can't flush part of its output.
+            raise template.TemplateSyntaxError(
+                "{% flush %} tags can only be streamed at the top "
+                "level of a template, or of a macro called there.")
+        # flush tags output nothing when not streaming.
+        return ''
+
+    def iter_render(self, context):
+        yield streaming.Flush(self.name)
+
+
+@register.tag(name="flush")
+def do_flush(parser, token):
+    """ Function taking a parsed template tag
+    to a FlushNode.
+    """
+    bits = token.split_contents()
+    if len(bits) > 2:
+        raise template.TemplateSyntaxError(
+            "'{0}' tag takes at most one argument (a name)".format(
+                bits[0]))
+    name = None
+    if len(bits) == 2:
+        name = bits[1]
+        if name[0] in ('"', "'") and name[-1] == name[0]:
+            name = name[1:-1]
+        else:
+            raise template.TemplateSyntaxError(
+                "Malformed argument to the {0} template tag."
+                " Argument must be in quotes.".format(bits[0]))
+    # the tags the flush tag is inside of, innermost last (the
+    # last command on the stack being the flush tag itself).
+    enclosing = getattr(parser, 'command_stack', [None])[:-1]
+    if enclosing and enclosing[-1][0] != 'macro':
+        raise template.TemplateSyntaxError(
+            "{0} tags can only be used at the top level of a template "
+            "or of a macro, not inside a {1} tag.".format(
+                bits[0], enclosing[-1][0]))
+    return FlushNode(name)
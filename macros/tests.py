@@ -2,6 +2,7 @@ from django.test import TestCase
 from django import template
 from django.template import Template, Context
 from django.shortcuts import render_to_response
+from django.test.client import RequestFactory
 
 # Parser creation factory for testing
 import django.template.base as template_base
@@ -232,7 +233,8 @@ class RepeatedBlocksTagsTests(TestCase):
 
 
 # Tests for macros.py
-from .templatetags.macros import _setup_macros_dict
+from .templatetags.macros import _setup_macros_dict, UseMacroNode
+from django.test.utils import override_settings
 
 class MacrosTests(TestCase):
 
@@ -641,6 +643,19 @@ class MacrosTests(TestCase):
         c = Context({'foo': self.FOO_VALUE})
         self.assertEqual(t.render(c), self.MACRO3_WITH_VARIABLE_RENDERED)
         
+    def test_later_arguments_see_earlier_ones(self):
+        """ arguments are bound in order, so a macro_kwarg, or
+        a kwarg, can use an argument passed before it.
+        """
+        t = Template(
+            self.LOAD_MACROS +
+            "{% macro m a b='' %}<{{ b }}>{% endmacro %}"
+            "{% macro_block m 'X' %}"
+            "{% macro_kwarg b %}{{ a }}{% endmacro_kwarg %}"
+            "{% endmacro_block %}"
+            "{% use_macro m 'Y' b=a %}")
+        self.assertEqual(t.render(Context()), "<X><Y>")
+
     def test_using_context_variable_in_macro_block(self):
         """ Macro block is meant to be able to accept context variables
         inside it's sub blocks.
@@ -1050,3 +1065,1406 @@ class MacrosTests(TestCase):
                     "contents"
                 "{% endmacro_kwarg %}"
             "{% endmacro_block %}")
+
+    def test_macro_bindings_are_scoped(self):
+        """ a macro's arguments should be bound only while its
+        body renders, leaving the caller's variables as they were.
+        """
+        t = Template(
+            self.LOAD_MACROS +
+            "{% macro inner x %}[{{ x }}]{% endmacro %}"
+            "{% macro outer x y='y' %}{{ x }}{% use_macro inner y %}"
+            "{{ x }}{% endmacro %}"
+            "{{ x }}{% use_macro outer 'a' %}{{ x }}{{ y }}"
+            "{% use_macro outer 'b' y='c' %}{{ x }}")
+        context = Context({'x': 'X'})
+        self.assertEqual(t.render(context), "Xa[y]aXb[c]bX")
+        # and the context is back to as it started
+        self.assertEqual(len(context.dicts), len(Context().dicts) + 1)
+
+    def test_use_macro_by(self):
+        """ use_macro_by should call the macro named by its
+        first argument, or the fallback macro for other names.
+        """
+        t = Template(
+            self.LOAD_MACROS +
+            "{% macro book item %}Book: {{ item.title }}{% endmacro %}"
+            "{% macro film item prefix='Film' %}{{ prefix }}: "
+            "{{ item.title }}{% endmacro %}"
+            "{% macro other item %}Other: {{ item.title }}{% endmacro %}"
+            "{% for item in items %}"
+            "{% use_macro_by item.kind item prefix=item.kind|upper "
+            "else other %};{% endfor %}")
+        self.assertEqual(
+            t.render(Context({'items': [
+                {'kind': 'book', 'title': 'A'},
+                {'kind': 'film', 'title': 'B'},
+                {'kind': 'song', 'title': 'C'},
+                {'kind': 'book', 'title': 'D'},
+            ]})),
+            "Book: A;FILM: B;Other: C;Book: D;")
+
+    def test_use_macro_by_without_fallback(self):
+        """ use_macro_by should raise for an unknown name without
+        a fallback, and for an undefined fallback.
+        """
+        t = Template(
+            self.LOAD_MACROS +
+            "{% macro book %}Book{% endmacro %}"
+            "{% use_macro_by 'book' %}{% use_macro_by kind %}")
+        self.assertRaisesRegexp(
+            template.TemplateSyntaxError,
+            r"^Macro 'song' is not defined previously to the "
+            r"use_macro_by tag, and it has no fallback$",
+            t.render,
+            Context({'kind': 'song'}))
+        self.assertRaisesRegexp(
+            template.TemplateSyntaxError,
+            r"^Macro 'other' is not defined previously to the "
+            r"use_macro_by tag$",
+            Template,
+            self.LOAD_MACROS + "{% use_macro_by kind else other %}")
+
+    def test_recursive_macro(self):
+        """ a macro defined with recursive should be able to
+        call itself.
+        """
+        t = Template(
+            self.LOAD_MACROS +
+            "{% macro tree node recursive %}{{ node.name }}"
+            "{% if node.children %}({% for child in node.children %}"
+            "{% use_macro tree child %}{% endfor %}){% endif %}"
+            "{% endmacro %}{% use_macro tree root %}")
+        root = {'name': 'a', 'children': [
+            {'name': 'b', 'children': [{'name': 'c'}]}, {'name': 'd'}]}
+        self.assertEqual(
+            t.render(Context({'root': root})), "a(b(c)d)")
+
+    @override_settings(MACROS_MAX_RECURSION_DEPTH=3)
+    def test_recursive_macro_depth_limit(self):
+        """ recursive calls nesting deeper than the limit should
+        raise an error.
+        """
+        t = Template(
+            self.LOAD_MACROS +
+            "{% macro count n recursive %}{{ n|length }}"
+            "{% if n|length < 5 %}{% use_macro count n|add:'x' %}{% endif %}"
+            "{% endmacro %}{% use_macro count 'x' %}")
+        self.assertRaisesRegexp(
+            template.TemplateSyntaxError,
+            r"^Macro 'count' exceeded the maximum recursion depth of 3$",
+            t.render,
+            Context())
+        # siblings don't count towards the depth
+        t = Template(
+            self.LOAD_MACROS +
+            "{% macro leaf n recursive %}{{ n }}{% endmacro %}"
+            "{% for i in '12345' %}{% use_macro leaf i %}{% endfor %}")
+        self.assertEqual(t.render(Context()), "12345")
+
+    def test_macro_not_recursive_by_default(self):
+        """ without recursive, a macro's body can't call it. """
+        self.assertRaisesRegexp(
+            template.TemplateSyntaxError,
+            r"^Macro 'tree' is not defined previously to the use_macro tag$",
+            Template,
+            self.LOAD_MACROS +
+            "{% macro tree node %}{% use_macro tree node %}{% endmacro %}")
+
+    def test_reuse_renders_shared_subtrees_once(self):
+        """ calls marked reuse should render once per render for
+        the same argument values.
+        """
+        calls = []
+
+        class Node(object):
+            def __init__(self, name, children=()):
+                self._name = name
+                self.children = children
+
+            @property
+            def name(self):
+                calls.append(self._name)
+                return self._name
+
+        shared = Node('s', [Node('t')])
+        root = Node('r', [Node('a', [shared]), Node('b', [shared])])
+        t = Template(
+            self.LOAD_MACROS +
+            "{% macro tree node recursive %}{{ node.name }}"
+            "{% if node.children %}({% for child in node.children %}"
+            "{% use_macro tree child reuse %}{% endfor %}){% endif %}"
+            "{% endmacro %}{% use_macro tree root %}")
+        self.assertEqual(
+            t.render(Context({'root': root})), "r(a(s(t))b(s(t)))")
+        self.assertEqual(calls, ['r', 'a', 's', 't', 'b'])
+
+    def test_use_macro_only(self):
+        """ a call marked only should render the macro's body in
+        a context holding nothing but its arguments, keeping the
+        caller's autoescaping.
+        """
+        t = Template(
+            self.LOAD_MACROS +
+            "{% macro show x y='<y>' %}{{ x }}{{ y }}{{ z }}{% endmacro %}"
+            "{% use_macro show z only %}|{% use_macro show z %}|"
+            "{% autoescape off %}{% use_macro show z only %}"
+            "{% endautoescape %}")
+        self.assertEqual(
+            t.render(Context({'z': '<z>'})),
+            "&lt;z&gt;<y>|&lt;z&gt;<y>&lt;z&gt;|<z><y>")
+        use = t.nodelist.get_nodes_by_type(UseMacroNode)[0]
+        self.assertIn('only', use.options)
+        self.assertEqual(len(use.args), 1)
+
+    def test_flag_named_argument(self):
+        """ a flag word standing for one of the macro's positional
+        arguments is passed as an argument, not taken as a flag.
+        """
+        t = Template(
+            self.LOAD_MACROS +
+            "{% macro show x %}[{{ x }}]{% endmacro %}"
+            "{% use_macro show only %}"
+            "{% macro_block show memo %}{% endmacro_block %}"
+            "{% macro_block show only %}{% macro_arg %}y{% endmacro_arg %}"
+            "{% endmacro_block %}")
+        self.assertEqual(
+            t.render(Context({'only': 'o', 'memo': 'm', 'x': 'x'})),
+            "[o][m][y]")
+        uses = t.nodelist.get_nodes_by_type(UseMacroNode)
+        self.assertEqual([use.options for use in uses[:2]], [{}, {}])
+        self.assertEqual(uses[2].options, {'only': True})
+
+    def test_macro_flag_used_as_argument(self):
+        """ a macro whose body uses the name of a trailing flag
+        should raise, rather than lose the argument.
+        """
+        for body in ("[{{ strip }}]", "{% if recursive %}x{% endif %}",
+                     "{{ x|default:strip }}",
+                     "{% include 'macros/tests/teststrip.html' %}",
+                     "{% include x %}"):
+            with self.assertRaises(template.TemplateSyntaxError):
+                Template(
+                    self.LOAD_MACROS +
+                    "{% macro m x strip recursive %}" + body +
+                    "{% endmacro %}")
+        # included without the context, or not using the flag.
+        for body in ("{% include x only %}",
+                     "{% include 'macros/tests/testholes.html' %}"):
+            Template(
+                self.LOAD_MACROS +
+                "{% macro m x strip recursive %}" + body + "{% endmacro %}")
+
+
+# Tests for cache.py
+import os
+import shutil
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from django.core.cache import cache as default_cache
+from django.utils.safestring import mark_safe, SafeData
+from . import cache as macro_cache
+
+class SlowValue(object):
+    """ a context value that is slow to look up, and counts
+    how many times it has been.
+    """
+
+    def __init__(self):
+        self.calls = 0
+
+    @property
+    def value(self):
+        time.sleep(0.1)
+        self.calls += 1
+        return self.calls
+
+
+class MacroCacheTests(TestCase):
+
+    LOAD_MACROS = "{% load macros %}"
+    # a macro whose output depends on context outside its
+    # arguments, so that cache hits can be told apart from
+    # fresh renders.
+    COUNTER_MACRO_DEFINITION = (
+        "{% macro counter name %}"
+            "{{ name }}:{{ count }};"
+        "{% endmacro %}")
+    USE_COUNTER_CACHED = (
+        "{% use_macro counter 'a' cache=300 %}")
+    USE_COUNTER_TAGGED = (
+        "{% use_macro counter p cache=300 tags='product:{{ p }}' %}")
+
+    def setUp(self):
+        default_cache.clear()
+        macro_cache.get_local_cache().clear()
+
+    def test_cached_macro_is_reused(self):
+        """ a cached macro call should render once and then
+        serve the stored fragment.
+        """
+        t = Template(self.LOAD_MACROS + self.COUNTER_MACRO_DEFINITION +
+            self.USE_COUNTER_CACHED)
+        self.assertEqual(t.render(Context({'count': 1})), "a:1;")
+        self.assertEqual(t.render(Context({'count': 2})), "a:1;")
+
+    def test_cached_macro_varies_on_arguments(self):
+        """ cached calls with different argument values must
+        not share a fragment.
+        """
+        t = Template(self.LOAD_MACROS + self.COUNTER_MACRO_DEFINITION +
+            self.USE_COUNTER_TAGGED)
+        self.assertEqual(t.render(Context({'p': 1, 'count': 1})), "1:1;")
+        self.assertEqual(t.render(Context({'p': 2, 'count': 2})), "2:2;")
+        self.assertEqual(t.render(Context({'p': 1, 'count': 3})), "1:1;")
+
+    def test_invalidate_tags(self):
+        """ invalidating a tag should purge only the fragments
+        rendered with that tag.
+        """
+        t = Template(self.LOAD_MACROS + self.COUNTER_MACRO_DEFINITION +
+            self.USE_COUNTER_TAGGED)
+        t.render(Context({'p': 1, 'count': 1}))
+        t.render(Context({'p': 2, 'count': 1}))
+        macro_cache.invalidate_tags("product:1")
+        self.assertEqual(t.render(Context({'p': 1, 'count': 2})), "1:2;")
+        self.assertEqual(t.render(Context({'p': 2, 'count': 2})), "2:1;")
+
+    def test_macro_kwarg_named_like_option(self):
+        """ a macro keyword argument named like a call site
+        option is passed to the macro, not taken as an option.
+        """
+        t = Template(self.LOAD_MACROS +
+            "{% macro m cache='' %}{{ cache }}{% endmacro %}"
+            "{% use_macro m cache='x' %}")
+        self.assertEqual(t.render(Context({})), "x")
+
+    def test_tags_without_cache_raises(self):
+        """ the tags option is meaningless without cache,
+        so it should raise an exception.
+        """
+        self.assertRaisesRegexp(
+            template.TemplateSyntaxError,
+            r"^.+ tag was given tags without a cache timeout.$",
+            Template,
+            self.LOAD_MACROS + self.COUNTER_MACRO_DEFINITION +
+            "{% use_macro counter 'a' tags='x' %}")
+
+    def test_local_tier_serves_hits(self):
+        """ once fetched from the backend, a fragment should
+        be served from the in-process tier.
+        """
+        t = Template(self.LOAD_MACROS + self.COUNTER_MACRO_DEFINITION +
+            self.USE_COUNTER_CACHED)
+        t.render(Context({'count': 1}))
+        macro_cache.get_local_cache().clear()
+        macro_cache.reset_stats()
+        t.render(Context({'count': 2}))
+        t.render(Context({'count': 3}))
+        stats = macro_cache.cache_stats()
+        self.assertEqual(stats['backend']['hits'], 1)
+        self.assertEqual(stats['local']['hits'], 1)
+        self.assertEqual(stats['local']['misses'], 1)
+
+
+    def test_concurrent_misses_render_once(self):
+        """ threads missing the same fragment at once should
+        wait for a single render.
+        """
+        slow = SlowValue()
+        t = Template(self.LOAD_MACROS +
+            "{% macro slow_macro %}{{ slow.value }}{% endmacro %}"
+            "{% use_macro slow_macro cache=300 %}")
+        results = []
+        def render():
+            results.append(t.render(Context({'slow': slow})))
+        threads = [threading.Thread(target=render) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(slow.calls, 1)
+        self.assertEqual(results, ["1"] * 5)
+
+    def test_waits_for_render_lock_held_elsewhere(self):
+        """ when another process holds the render lock, the
+        fragment it stores should be used instead of rendering.
+        """
+        key = "macros.fragment.test"
+        default_cache.add(macro_cache.LOCK_KEY_TEMPLATE.format(key), 1)
+        def store():
+            time.sleep(0.1)
+            macro_cache.set_fragment(key, "rendered elsewhere", 300)
+        thread = threading.Thread(target=store)
+        thread.start()
+        value = macro_cache.get_or_render(key, lambda: "rendered here", 300)
+        thread.join()
+        self.assertEqual(value, "rendered elsewhere")
+
+
+    def test_stale_fragment_served_while_refreshed(self):
+        """ a cached call past its timeout but within its stale
+        period should serve the stale fragment immediately, and
+        refresh it in the background.
+        """
+        t = Template(self.LOAD_MACROS + self.COUNTER_MACRO_DEFINITION +
+            "{% use_macro counter 'a' cache=0 stale=300 %}")
+        self.assertEqual(t.render(Context({'count': 1})), "a:1;")
+        self.assertEqual(t.render(Context({'count': 2})), "a:1;")
+        macro_cache.wait_for_refreshes()
+        macro = t.nodelist.get_nodes_by_type(DefineMacroNode)[0]
+        key = macro_cache.make_fragment_key(macro.cache_name(), ['name=a'])
+        self.assertEqual(macro_cache.get_entry(key), ("a:2;", False))
+
+    def test_macros_cached_per_definition(self):
+        """ macros of the same name defined in different templates
+        shouldn't share cached fragments.
+        """
+        first = Template(
+            self.LOAD_MACROS +
+            "{% macro card n %}A{{ n }}{% endmacro %}"
+            "{% use_macro card 1 cache=300 %}")
+        second = Template(
+            self.LOAD_MACROS +
+            "{% macro card n %}B{{ n }}{% endmacro %}"
+            "{% use_macro card 1 cache=300 %}")
+        self.assertEqual(first.render(Context()), "A1")
+        self.assertEqual(second.render(Context()), "B1")
+
+    def test_loaded_macros_share_fragments(self):
+        """ a macro from a template loaded by name should be cached
+        under the same key wherever the template is compiled.
+        """
+        source = "macros/tests/testholes.html"
+        first = get_template(source).template
+        second = get_template(source).template
+        key = lambda t: t.nodelist.get_nodes_by_type(
+            DefineMacroNode)[0].cache_name()
+        self.assertEqual(key(first), key(second))
+
+    def test_stale_without_cache_raises(self):
+        """ the stale option is meaningless without cache,
+        so it should raise an exception.
+        """
+        self.assertRaisesRegexp(
+            template.TemplateSyntaxError,
+            r"^.+ tag was given stale without a cache timeout.$",
+            Template,
+            self.LOAD_MACROS + self.COUNTER_MACRO_DEFINITION +
+            "{% use_macro counter 'a' stale=300 %}")
+
+
+    def test_local_tier_counts_fragment_size(self):
+        """ the local tier should count a fragment stored through
+        set_fragment (or fetched by get_entry) by the fragment's
+        size, not the size of the entry wrapping it.
+        """
+        value = 'x' * 200000
+        local = macro_cache.get_local_cache()
+        local.clear()
+        macro_cache.set_fragment("macros.fragment.sized", value, 300)
+        self.assertGreaterEqual(local.size, sys.getsizeof(value))
+        local.clear()
+        macro_cache.get_entry("macros.fragment.sized")
+        self.assertGreaterEqual(local.size, sys.getsizeof(value))
+
+    def test_large_fragments_stored_compressed(self):
+        """ fragments over the size threshold should be stored
+        compressed in the backend, and come back unchanged.
+        """
+        value = mark_safe("<li>item</li>" * 2000)
+        macro_cache.reset_stats()
+        macro_cache.set_fragment("macros.fragment.large", value, 300)
+        macro_cache.set_fragment("macros.fragment.small", "small", 300)
+        stored = default_cache.get("macros.fragment.large")
+        self.assertIsInstance(stored[0], macro_cache.CompressedFragment)
+        self.assertEqual(default_cache.get("macros.fragment.small")[0],
+                         "small")
+        macro_cache.get_local_cache().clear()
+        fragment = macro_cache.get_fragment("macros.fragment.large")
+        self.assertEqual(fragment, value)
+        self.assertIsInstance(fragment, SafeData)
+        stats = macro_cache.cache_stats()['compression']
+        self.assertEqual(stats['compressed'], 1)
+        self.assertEqual(stats['decompressed'], 1)
+        self.assertLess(stats['ratio'], 0.1)
+
+
+class LocalFragmentCacheTests(TestCase):
+
+    def test_evicts_least_recently_used_entry(self):
+        """ when over max_entries, the least recently used
+        entry should be evicted.
+        """
+        local = macro_cache.LocalFragmentCache(2, 1024 * 1024, 60)
+        local.set('a', 'A')
+        local.set('b', 'B')
+        local.get('a')
+        local.set('c', 'C')
+        self.assertEqual(local.get('a'), 'A')
+        self.assertIsNone(local.get('b'))
+        self.assertEqual(local.get('c'), 'C')
+
+    def test_evicts_to_fit_max_bytes(self):
+        """ the total size of the entries must stay within
+        max_bytes.
+        """
+        value = 'x' * 1000
+        local = macro_cache.LocalFragmentCache(
+            100, 3 * sys.getsizeof(value), 60)
+        for i in range(5):
+            local.set(i, value)
+        self.assertEqual(len(local), 3)
+        self.assertLessEqual(local.size, local.max_bytes)
+
+    def test_entries_expire(self):
+        """ entries must not outlive their timeout. """
+        local = macro_cache.LocalFragmentCache(10, 1024 * 1024, 60)
+        local.set('a', 'A', timeout=-1)
+        self.assertIsNone(local.get('a'))
+
+
+class DiskFragmentCacheTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'fragments.sqlite3')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_fragments_persist(self):
+        """ fragments should be readable by another instance
+        opening the same file, e.g. after a restart.
+        """
+        macro_cache.DiskFragmentCache(self.path, 1024 * 1024).set(
+            'a', ('A', None, None))
+        disk = macro_cache.DiskFragmentCache(self.path, 1024 * 1024)
+        self.assertEqual(disk.get('a'), ('A', None, None))
+        self.assertIsNone(disk.get('b'))
+
+    def test_fragments_expire(self):
+        """ expired fragments must not be returned. """
+        disk = macro_cache.DiskFragmentCache(self.path, 1024 * 1024)
+        disk.set('a', 'A', timeout=-1)
+        self.assertIsNone(disk.get('a'))
+
+    def test_hit_while_database_locked(self):
+        """ a hit should be returned, without waiting out the
+        lock timeout, while another connection holds the write
+        lock, though its access time can't be written back.
+        """
+        disk = macro_cache.DiskFragmentCache(self.path, 1024 * 1024)
+        disk.touch_interval = -1
+        disk.set('a', 'A')
+        other = sqlite3.connect(self.path, isolation_level=None)
+        other.execute('BEGIN IMMEDIATE')
+        try:
+            start = time.time()
+            self.assertEqual(disk.get('a'), 'A')
+            self.assertLess(time.time() - start, disk.timeout)
+        finally:
+            other.execute('ROLLBACK')
+            other.close()
+
+    def test_evicts_least_recently_used_to_fit_max_bytes(self):
+        """ once over max_bytes, the least recently used
+        fragments should be evicted.
+        """
+        value = 'x' * 1000
+        disk = macro_cache.DiskFragmentCache(self.path, 3500)
+        disk.touch_interval = -1
+        for key in ('a', 'b', 'c'):
+            disk.set(key, value)
+        disk.get('a')
+        disk.set('d', value)
+        self.assertEqual(disk.get('a'), value)
+        self.assertIsNone(disk.get('b'))
+        self.assertEqual(disk.get('c'), value)
+        self.assertEqual(disk.get('d'), value)
+        self.assertLessEqual(disk.size, 3500)
+
+
+class SharedFragmentCacheTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'fragments.mmap')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_fragments_shared_between_mappings(self):
+        """ a fragment stored through one mapping of the file,
+        as by one worker, should be read through another.
+        """
+        writer = macro_cache.SharedFragmentCache(self.path, 64 * 1024, 1024)
+        reader = macro_cache.SharedFragmentCache(self.path, 64 * 1024, 1024)
+        writer.set('a', ('A', None, None))
+        self.assertEqual(reader.get('a'), ('A', None, None))
+        self.assertIsNone(reader.get('b'))
+        writer.delete('a')
+        self.assertIsNone(reader.get('a'))
+
+    def test_fragments_expire(self):
+        """ expired fragments must not be returned. """
+        shared = macro_cache.SharedFragmentCache(self.path, 64 * 1024, 1024)
+        shared.set('a', 'A', timeout=-1)
+        self.assertIsNone(shared.get('a'))
+
+    def test_fragments_larger_than_a_slot_not_stored(self):
+        """ fragments that don't fit in a slot are skipped. """
+        shared = macro_cache.SharedFragmentCache(self.path, 64 * 1024, 1024)
+        shared.set('a', 'x' * 2000)
+        self.assertIsNone(shared.get('a'))
+
+    def test_slot_being_written_is_a_miss(self):
+        """ readers must not see a slot whose sequence shows
+        it is being written.
+        """
+        shared = macro_cache.SharedFragmentCache(self.path, 64 * 1024, 1024)
+        shared.set('a', 'A')
+        digest, offset = shared._slot('a')
+        mapping = shared._mapping()
+        sequence = shared.header.unpack_from(mapping, offset)[0]
+        struct.pack_into('<Q', mapping, offset, sequence + 1)
+        self.assertIsNone(shared.get('a'))
+
+    def test_unpicklable_slot_is_a_miss(self):
+        """ a slot whose bytes pass the checks but don't unpickle
+        should be a miss, not an error.
+        """
+        shared = macro_cache.SharedFragmentCache(self.path, 64 * 1024, 1024)
+        shared.set('a', 'A')
+        digest, offset = shared._slot('a')
+        mapping = shared._mapping()
+        header = shared.header.unpack_from(mapping, offset)
+        data = b'\x80\x04not a pickle'
+        start = offset + shared.header.size
+        mapping[start:start + len(data)] = data
+        shared.header.pack_into(
+            mapping, offset, header[0], digest, header[2], len(data),
+            zlib.crc32(data) & 0xffffffff)
+        self.assertIsNone(shared.get('a'))
+
+    def test_concurrent_threads(self):
+        """ threads writing and reading one slot should only
+        ever read back whole values stored at the key read.
+        """
+        shared = macro_cache.SharedFragmentCache(self.path, 1024, 1024)
+        errors = []
+        stop = time.time() + 0.5
+
+        def write(i):
+            while time.time() < stop:
+                shared.set('key{0}'.format(i), ('key{0}'.format(i)) * 50)
+
+        def read(i):
+            while time.time() < stop:
+                try:
+                    value = shared.get('key{0}'.format(i))
+                except Exception as e:
+                    errors.append(e)
+                    return
+                if value is not None and value != ('key{0}'.format(i)) * 50:
+                    errors.append(value)
+                    return
+
+        threads = [threading.Thread(target=f, args=(i,))
+                   for i in range(3) for f in (write, read)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+
+# Tests for holes.py
+from django.template.loader import get_template
+from . import holes
+
+class HolesTests(TestCase):
+
+    LOAD_MACROS = "{% load macros %}"
+    PAGE = (
+        "{% load macros %}"
+        "{% macro greeting name %}Hello {{ name }}, {{ user }}!{% endmacro %}"
+        "<h1>{{ title }}</h1>"
+        "{% use_macro greeting 'visitor' dynamic %}")
+
+    def test_dynamic_flag_renders_normally(self):
+        """ outside of hole punching, a dynamic call should
+        render like any other.
+        """
+        t = Template(self.PAGE)
+        self.assertEqual(t.render(Context({'title': 'T', 'user': 'ann'})),
+                         "<h1>T</h1>Hello visitor, ann!")
+
+    def test_skeleton_filled_per_request(self):
+        """ the skeleton should hold a placeholder for the
+        dynamic call, filled from each request's context.
+        """
+        t = Template(self.PAGE)
+        skeleton = holes.render_skeleton(
+            t, Context({'title': 'T', 'user': 'ann'}))
+        self.assertTrue(skeleton.startswith("<h1>T</h1><!--macros-hole:"))
+        self.assertNotIn("ann", skeleton)
+        self.assertEqual(
+            holes.fill_holes(skeleton, Context({'title': 'X', 'user': 'bob'})),
+            "<h1>T</h1>Hello visitor, bob!")
+
+    def test_forged_placeholder_left_alone(self):
+        """ placeholders without a valid signature must not
+        be filled.
+        """
+        forged = "<!--macros-hole:abc:def-->"
+        self.assertEqual(holes.fill_holes(forged, Context({})), forged)
+
+    def test_dynamic_variable_argument(self):
+        """ a trailing argument named like a flag is a flag,
+        but other arguments still work.
+        """
+        t = Template(self.PAGE.replace("'visitor'", "person"))
+        skeleton = holes.render_skeleton(
+            t, Context({'title': 'T', 'person': '<b>'}))
+        self.assertEqual(
+            holes.fill_holes(skeleton, Context({'user': 'bob'})),
+            "<h1>T</h1>Hello &lt;b&gt;, bob!")
+
+    def test_macros_with_the_same_name(self):
+        """ holes should be filled by the macro that left them,
+        when other templates (or redefinitions) use its name.
+        """
+        first = Template(
+            self.LOAD_MACROS +
+            "{% macro g %}A-body{% endmacro %}{% use_macro g dynamic %}")
+        second = Template(
+            self.LOAD_MACROS +
+            "{% macro g %}B-body{% endmacro %}{% use_macro g dynamic %}"
+            "{% macro g %}C-body{% endmacro %}{% use_macro g dynamic %}")
+        first_skeleton = holes.render_skeleton(first, Context())
+        second_skeleton = holes.render_skeleton(second, Context())
+        self.assertEqual(
+            holes.fill_holes(first_skeleton, Context()), "A-body")
+        self.assertEqual(
+            holes.fill_holes(second_skeleton, Context()), "B-bodyC-body")
+
+    CACHED_PAGE = (
+        "{% load macros %}"
+        "{% macro greeting %}Hello {{ user }}{% endmacro %}"
+        "{% macro box %}[{% use_macro greeting dynamic %}]{% endmacro %}"
+        "{% use_macro box cache=300 %}")
+
+    def test_cached_macro_then_skeleton(self):
+        """ a skeleton shouldn't use a cached fragment rendered
+        for one user in place of the dynamic call inside it.
+        """
+        default_cache.clear()
+        macro_cache.get_local_cache().clear()
+        t = Template(self.CACHED_PAGE)
+        self.assertEqual(t.render(Context({'user': 'ann'})), "[Hello ann]")
+        skeleton = holes.render_skeleton(t, Context({'user': 'ann'}))
+        self.assertEqual(
+            holes.fill_holes(skeleton, Context({'user': 'bob'})),
+            "[Hello bob]")
+
+    def test_skeleton_then_cached_macro(self):
+        """ a normal render shouldn't use a cached fragment holding
+        placeholders, rendered for a skeleton.
+        """
+        default_cache.clear()
+        macro_cache.get_local_cache().clear()
+        t = Template(self.CACHED_PAGE)
+        holes.render_skeleton(t, Context({'user': 'ann'}))
+        self.assertEqual(t.render(Context({'user': 'bob'})), "[Hello bob]")
+
+    def test_macro_loaded_by_template_name(self):
+        """ a process that hasn't rendered the macro should find
+        it by loading the template the placeholder names.
+        """
+        t = get_template('macros/tests/testholes.html').template
+        skeleton = holes.render_skeleton(t, Context({'title': 'T'}))
+        holes._macros.clear()
+        self.assertEqual(
+            holes.fill_holes(skeleton, Context({'user': 'bob'})),
+            "<h1>T</h1>Hello bob!")
+
+    def test_render_with_holes_caches_skeleton(self):
+        """ render_with_holes should render the skeleton once,
+        and fill its holes on every request.
+        """
+        default_cache.clear()
+        macro_cache.get_local_cache().clear()
+        request = RequestFactory().get('/page/')
+        response = holes.render_with_holes(
+            request, 'macros/tests/testholes.html',
+            {'title': 'T', 'user': 'ann'})
+        self.assertEqual(response.content, b"<h1>T</h1>Hello ann!")
+        response = holes.render_with_holes(
+            request, 'macros/tests/testholes.html',
+            {'title': 'X', 'user': 'bob'})
+        self.assertEqual(response.content, b"<h1>T</h1>Hello bob!")
+
+
+# Tests for deferred.py
+import datetime
+from django.utils import timezone
+from . import deferred
+
+class Sleeper(object):
+    """ a context value whose lookup waits, as if on I/O. """
+
+    @property
+    def value(self):
+        time.sleep(0.1)
+        return "z"
+
+
+class Rendezvous(object):
+    """ a context value whose lookups wait (for up to five
+    seconds) for expected lookups to be in progress at once,
+    recording the most there were.
+    """
+
+    def __init__(self, expected):
+        self.expected = expected
+        self.active = 0
+        self.most = 0
+        self.condition = threading.Condition()
+
+    @property
+    def value(self):
+        deadline = time.time() + 5
+        with self.condition:
+            self.active += 1
+            self.most = max(self.most, self.active)
+            self.condition.notify_all()
+            while self.most < self.expected and time.time() < deadline:
+                self.condition.wait(deadline - time.time())
+            self.active -= 1
+        return "z"
+
+
+class DeferredTests(TestCase):
+
+    PAGE = (
+        "{% load macros %}"
+        "{% macro slow_macro n %}[{{ n }}:{{ slow.value }}]{% endmacro %}"
+        "a{% use_macro slow_macro 1 deferred %}"
+        "b{% use_macro slow_macro 2 deferred %}"
+        "c{% use_macro slow_macro 3 deferred %}d")
+
+    def test_deferred_calls_render_concurrently(self):
+        """ deferred calls should render at the same time,
+        spliced into the output where they were called.
+        """
+        t = Template(self.PAGE)
+        slow = Rendezvous(3)
+        output = deferred.render_deferred(t, Context({'slow': slow}))
+        self.assertEqual(slow.most, 3)
+        self.assertEqual(output, "a[1:z]b[2:z]c[3:z]d")
+
+    def test_deferred_output_matches_serial_output(self):
+        """ a deferred render must give the same output as
+        rendering the calls in turn.
+        """
+        t = Template(self.PAGE)
+        self.assertEqual(
+            deferred.render_deferred(t, Context({'slow': Sleeper()})),
+            t.render(Context({'slow': Sleeper()})))
+
+    def test_deferred_calls_in_a_loop(self):
+        """ deferred calls in a loop should see the loop's values
+        as they were when the call was made.
+        """
+        t = Template(
+            "{% load macros %}"
+            "{% macro m x %}[{{ x }}:{{ item }}:{{ forloop.counter }}"
+            "{{ forloop.parentloop.counter }}]{% endmacro %}"
+            "{% for row in rows %}{% for item in row %}"
+            "{% use_macro m item deferred %}{% endfor %}{% endfor %}")
+        context = {'rows': [['a', 'b'], ['c']]}
+        self.assertEqual(
+            deferred.render_deferred(t, Context(context)),
+            "[a:a:11][b:b:21][c:c:12]")
+        self.assertEqual(
+            deferred.render_deferred(t, Context(context)),
+            t.render(Context(context)))
+
+    def test_deferred_calls_keep_time_zone(self):
+        """ the active time zone should be carried over to the
+        threads rendering deferred calls.
+        """
+        t = Template(
+            "{% load macros %}{% macro hour %}{{ when|date:'H' }}"
+            "{% endmacro %}{% use_macro hour deferred %}")
+        when = datetime.datetime(2020, 1, 1, tzinfo=timezone.utc)
+        with self.settings(USE_TZ=True):
+            with timezone.override('Asia/Tokyo'):
+                self.assertEqual(
+                    deferred.render_deferred(t, Context({'when': when})),
+                    t.render(Context({'when': when})))
+
+    def test_deferred_calls_have_own_render_context(self):
+        """ each captured call should render with its own render
+        context state, so that tag state isn't shared between the
+        threads rendering them.
+        """
+        t = Template(
+            "{% load macros %}{% macro m %}{% endmacro %}"
+            "{% use_macro m deferred %}")
+        node = t.nodelist.get_nodes_by_type(UseMacroNode)[0]
+        context = Context()
+        context.render_context['state'] = 'outer'
+        snapshots = []
+        node.render_macro = lambda context, bindings: snapshots.append(
+            context)
+        try:
+            node.snapshot(context, [])()
+        finally:
+            del node.render_macro
+        self.assertIsNot(
+            snapshots[0].render_context.dicts[-1],
+            context.render_context.dicts[-1])
+        self.assertNotIn('state', snapshots[0].render_context)
+        self.assertEqual(context.render_context['state'], 'outer')
+
+    def test_deferred_recursive_macros(self):
+        """ deferred calls of a recursive macro, rendered at the
+        same time, should each count only their own depth.
+        """
+        t = Template(
+            "{% load macros %}"
+            "{% macro count n recursive %}.{% if n %}"
+            "{% use_macro count n.next %}{% endif %}{% endmacro %}"
+            "{% use_macro count root deferred %}"
+            "{% use_macro count root deferred %}"
+            "{% use_macro count root deferred %}"
+            "{% use_macro count root deferred %}")
+
+        class Link(object):
+            def __init__(self, next):
+                self._next = next
+
+            @property
+            def next(self):
+                # slow enough for the calls to overlap
+                time.sleep(0.002)
+                return self._next
+
+        root = None
+        for i in range(20):
+            root = Link(root)
+        for attempt in range(3):
+            self.assertEqual(
+                deferred.render_deferred(t, Context({'root': root})),
+                "." * 21 * 4)
+
+    @override_settings(MACROS_MAX_RECURSION_DEPTH=3)
+    def test_deferred_recursive_calls_keep_their_depth(self):
+        """ a deferred call made from inside a recursive macro
+        should carry on the depth it was called at.
+        """
+        t = Template(
+            "{% load macros %}"
+            "{% macro count n recursive %}.{% if n %}"
+            "{% use_macro count n.next deferred %}{% endif %}{% endmacro %}"
+            "{% use_macro count root %}")
+        two = {'next': {'next': None}}
+        self.assertEqual(
+            deferred.render_deferred(t, Context({'root': two})), "...")
+        three = {'next': two}
+        self.assertRaisesRegexp(
+            template.TemplateSyntaxError,
+            r"^Macro 'count' exceeded the maximum recursion depth of 3$",
+            deferred.render_deferred, t, Context({'root': three}))
+
+
+# Tests for asyncrender.py, which need Python 3.5+ and asgiref,
+# so live in a module of their own.
+try:
+    from .async_tests import AsyncRenderTests
+except (ImportError, SyntaxError):
+    pass
+
+
+# Tests for streaming.py
+from . import streaming
+
+class StreamingTests(TestCase):
+
+    PAGE = (
+        "{% load macros %}"
+        "{% macro item n %}<li>{{ n }}</li>{% endmacro %}"
+        "<ul>{% use_macro item 1 %}{% use_macro item 2 %}</ul>")
+
+    def test_streams_macro_calls(self):
+        """ each macro call should be yielded as its own chunk,
+        and the chunks should add up to the normal render.
+        """
+        t = Template(self.PAGE)
+        chunks = list(streaming.stream_template(t, Context({})))
+        self.assertEqual(chunks, ["<ul>", "<li>1</li>", "<li>2</li>", "</ul>"])
+        self.assertEqual("".join(chunks), t.render(Context({})))
+
+    def test_streaming_response(self):
+        """ streaming_response should stream the rendered
+        template.
+        """
+        request = RequestFactory().get('/')
+        response = streaming.streaming_response(
+            request, 'macros/tests/testholes.html',
+            {'title': 'T', 'user': 'ann'})
+        self.assertEqual(b"".join(response.streaming_content),
+                         b"<h1>T</h1>Hello ann!")
+
+    def test_flush_sets_chunk_boundaries(self):
+        """ with flush tags, chunks should end exactly at each
+        flush, and each chunk's render time be recorded.
+        """
+        t = Template(self.PAGE.replace("<ul>", "<head></head>{% flush 'head' %}<ul>"))
+        timings = []
+        chunks = list(streaming.stream_template(t, Context({}), timings))
+        self.assertEqual(chunks, ["<head></head>", "<ul><li>1</li><li>2</li></ul>"])
+        self.assertEqual([name for name, seconds in timings], ["head"])
+
+    def test_flush_in_loaded_macro(self):
+        """ flush tags in macros loaded from a sheet should set
+        the chunk boundaries too.
+        """
+        t = Template(
+            "{% load macros %}{% loadmacros 'macros/tests/testflush.html' %}"
+            "{% use_macro page 'T' %}")
+        timings = []
+        chunks = list(streaming.stream_template(t, Context({}), timings))
+        self.assertEqual(chunks, ["<head>T</head>", "<body></body>"])
+        self.assertEqual([name for name, seconds in timings], ["head"])
+
+    def test_flush_inside_other_tags_raises(self):
+        """ flush tags inside tags that can't stream their output
+        should raise, rather than being ignored.
+        """
+        for source in (
+                "{% load macros %}{% if x %}{% flush %}{% endif %}",
+                "{% load macros %}{% block b %}{% flush %}{% endblock %}",
+                "{% extends 'base.html' %}{% load macros %}{% flush %}"):
+            with self.assertRaisesRegexp(
+                    template.TemplateSyntaxError, r"not inside a"):
+                Template(source)
+
+    def test_flush_rendered_without_streaming_raises(self):
+        """ a flush tag in a macro called where it can't be
+        streamed should raise while streaming.
+        """
+        t = Template(
+            "{% load macros %}{% macro m %}a{% flush %}b{% endmacro %}"
+            "{% if True %}{% use_macro m %}{% endif %}")
+        with self.assertRaises(template.TemplateSyntaxError):
+            list(streaming.stream_template(t, Context({})))
+        self.assertEqual(t.render(Context({})), "ab")
+
+    def test_flush_renders_nothing(self):
+        """ outside of streaming, flush tags output nothing. """
+        t = Template("{% load macros %}a{% flush %}b")
+        self.assertEqual(t.render(Context({})), "ab")
+
+    def test_flush_with_malformed_name(self):
+        """ the flush tag's name must be quoted. """
+        self.assertRaisesRegexp(
+            template.TemplateSyntaxError,
+            r"^Malformed argument to the flush template tag."
+            r" Argument must be in quotes.$",
+            Template,
+            "{% load macros %}{% flush head %}")
+
+
+# Tests for writer.py
+from . import writer
+
+class WriterTests(TestCase):
+
+    # macros nested five deep, each wrapping the next.
+    NESTED = (
+        "{% load macros %}"
+        "{% macro cell v %}<td>{{ v }}</td>{% endmacro %}"
+        "{% macro row v %}<tr>{% use_macro cell v %}</tr>{% endmacro %}"
+        "{% macro list v %}<table>{% use_macro row v %}</table>{% endmacro %}"
+        "{% macro card v %}<div>{% use_macro list v %}</div>{% endmacro %}"
+        "{% macro layout v %}<body>{% use_macro card v %}</body>{% endmacro %}"
+        "{% use_macro layout value %}")
+    NESTED_RENDERED = (
+        "<body><div><table><tr><td>x</td></tr></table></div></body>")
+
+    def test_writes_nested_macros(self):
+        """ nested macros should write into the one writer,
+        and match the normal render.
+        """
+        t = Template(self.NESTED)
+        bits = []
+        writer.write_nodelist(t.nodelist, Context({'value': 'x'}), bits.append)
+        self.assertEqual("".join(bits), self.NESTED_RENDERED)
+        self.assertEqual(
+            writer.render_template(t, Context({'value': 'x'})),
+            self.NESTED_RENDERED)
+        self.assertEqual(t.render(Context({'value': 'x'})),
+                         self.NESTED_RENDERED)
+
+    def test_render_bytes(self):
+        """ rendering to bytes should give the utf-8 encoding
+        of the normal render, using the pre-encoded text.
+        """
+        t = Template(self.NESTED.replace("<td>", "<td>é"))
+        self.assertEqual(
+            t.nodelist.get_nodes_by_type(template_base.TextNode)[0].encoded,
+            "<td>é".encode('utf-8'))
+        cell = t.nodelist.get_nodes_by_type(DefineMacroNode)[0]
+        self.assertEqual(
+            cell.encoded_parts, ("<td>é".encode('utf-8'), b"</td>"))
+        self.assertEqual(
+            writer.render_template_bytes(t, Context({'value': 'ü'})),
+            t.render(Context({'value': 'ü'})).encode('utf-8'))
+
+    def test_bytes_response(self):
+        """ bytes_response should respond with the rendered
+        template.
+        """
+        request = RequestFactory().get('/')
+        response = writer.bytes_response(
+            request, 'macros/tests/testholes.html',
+            {'title': 'T', 'user': 'ann'})
+        self.assertEqual(response.content, b"<h1>T</h1>Hello ann!")
+
+
+# Tests for optimize.py
+from .templatetags.macros import DefineMacroNode, MacroArgNode
+
+class OptimizeTests(TestCase):
+
+    LOAD_MACROS = "{% load macros %}"
+    INDENTED_MACRO = (
+        "{{% macro list items {0}%}}\n"
+        "    <ul>\n"
+        "        {{% for item in items %}}\n"
+        "            <li>{{{{ item }}}}  here</li>\n"
+        "        {{% endfor %}}\n"
+        "    </ul>\n"
+        "    <pre>\n  keep  this\n</pre>\n"
+        "{{% endmacro %}}"
+        "{{% use_macro list items %}}")
+
+    def test_strip_collapses_whitespace(self):
+        """ a macro defined with strip should render without the
+        whitespace between tags, and with a single space next to
+        template tags, except in <pre>.
+        """
+        t = Template(self.LOAD_MACROS + self.INDENTED_MACRO.format("strip "))
+        self.assertEqual(
+            t.render(Context({'items': [1, 2]})),
+            " <ul>  <li>1 here</li>  <li>2 here</li>  </ul>"
+            "<pre>\n  keep  this\n</pre> ")
+
+    def test_strip_keeps_space_next_to_template_tags(self):
+        """ the space between a variable and an html tag is kept,
+        as is whitespace within text.
+        """
+        t = Template(
+            self.LOAD_MACROS +
+            "{% macro greet name strip %}"
+            "Say  hello   {{ name }} <em>!</em>\n<br>"
+            "{% endmacro %}"
+            "{% use_macro greet 'Bob' %}")
+        self.assertEqual(t.render(Context()), "Say  hello Bob <em>!</em><br>")
+
+    def test_strip_leaves_script_and_style(self):
+        """ the content of <script> and <style> elements is left
+        as it is.
+        """
+        t = Template(
+            self.LOAD_MACROS +
+            "{% macro js strip %}"
+            "<div>\n  <script>\n // init\n init();\n</script>\n"
+            "<style>\n p {  }\n</style>\n</div>"
+            "{% endmacro %}"
+            "{% use_macro js %}")
+        self.assertEqual(
+            t.render(Context()),
+            "<div><script>\n // init\n init();\n</script>"
+            "<style>\n p {  }\n</style></div>")
+
+    def test_no_strip_by_default(self):
+        """ without strip, whitespace is left alone. """
+        t = Template(self.LOAD_MACROS + self.INDENTED_MACRO.format(""))
+        self.assertIn("\n    <ul>\n", t.render(Context({'items': []})))
+
+    @override_settings(MACROS_STRIP_WHITESPACE=True)
+    def test_strip_setting(self):
+        """ the MACROS_STRIP_WHITESPACE setting should strip
+        every macro.
+        """
+        t = Template(self.LOAD_MACROS + self.INDENTED_MACRO.format(""))
+        self.assertNotIn("\n", t.render(Context({'items': []})).split("<pre>")[0])
+
+    def test_flatten_merges_text(self):
+        """ comments and loads in a macro's body should be
+        dropped, and the text around them merged.
+        """
+        t = Template(
+            self.LOAD_MACROS +
+            "{% macro greet name %}Hello {# comment #}"
+            "{% comment %}more{% endcomment %}{% load macros %}"
+            "{{ name }}{# comment #}!{% endmacro %}"
+            "{% use_macro greet 'you' %}")
+        nodelist = t.nodelist.get_nodes_by_type(DefineMacroNode)[0].nodelist
+        self.assertEqual(len(nodelist), 3)
+        self.assertEqual(nodelist[0].s, "Hello ")
+        self.assertEqual(t.render(Context()), "Hello you!")
+
+    def test_flatten_macro_arg(self):
+        """ macro_arg bodies should be flattened too. """
+        t = Template(
+            self.LOAD_MACROS +
+            "{% macro show arg %}{{ arg }}{% endmacro %}"
+            "{% macro_block show %}{% macro_arg %}a{# b #}c"
+            "{% endmacro_arg %}{% endmacro_block %}")
+        self.assertEqual(t.render(Context()), "ac")
+        arg_node = t.nodelist.get_nodes_by_type(MacroArgNode)[0]
+        self.assertEqual(len(arg_node.nodelist), 1)
+
+    def test_template_string_macro(self):
+        """ a macro of only text and variables should be lowered
+        to static parts and slots, and render the same, with
+        autoescaping and missing values as usual.
+        """
+        t = Template(
+            self.LOAD_MACROS +
+            "{% macro link url text=\"none\" %}<a href=\"{{ url }}\">"
+            "{{ text|upper }}</a>{{ missing }}{% endmacro %}"
+            "{% use_macro link url text=text %}")
+        macro = t.nodelist.get_nodes_by_type(DefineMacroNode)[0]
+        static, slots = macro.parts
+        self.assertEqual(
+            static, ('<a href="', '">', '</a>', ''))
+        self.assertEqual(len(slots), 3)
+        self.assertEqual(
+            t.render(Context({'url': '/a?b&c', 'text': '<b>'})),
+            '<a href="/a?b&amp;c">&lt;B&gt;</a>')
+
+    def test_template_string_macro_needs_only_variables(self):
+        """ a macro with other tags in it shouldn't be lowered. """
+        t = Template(
+            self.LOAD_MACROS +
+            "{% macro m x %}{% if x %}{{ x }}{% endif %}{% endmacro %}")
+        macro = t.nodelist.get_nodes_by_type(DefineMacroNode)[0]
+        self.assertIsNone(macro.parts)
+
+
+
+# Tests for lookups.py
+from . import lookups
+from .lookups import CachedVariable, ATTRIBUTE, INDEX, ITEM
+
+class LookupsTests(TestCase):
+
+    class Product(object):
+        def __init__(self, name):
+            self.name = name
+
+        def label(self):
+            return self.name.upper()
+
+        def delete(self):
+            raise AssertionError("alters_data methods mustn't be called")
+        delete.alters_data = True
+
+    class Broken(object):
+        @property
+        def name(self):
+            raise AttributeError("raised inside the property")
+
+    def resolve(self, variable, values):
+        try:
+            return variable.resolve(Context(values))
+        except template.VariableDoesNotExist:
+            return template.VariableDoesNotExist
+
+    def test_resolves_like_variable(self):
+        """ a CachedVariable should resolve dictionary, attribute,
+        index and method lookups as template.Variable does, both
+        before and after its caches are filled.
+        """
+        values = {
+            'row': {'product': self.Product('tea')},
+            'rows': [self.Product('coffee')],
+        }
+        for var in ('row.product.name', 'rows.0.name', 'row.product.label',
+                    'row.missing', 'rows.5',
+                    'row.items'):
+            expected = self.resolve(template.Variable(var), values)
+            variable = CachedVariable(var)
+            for attempt in range(2):
+                self.assertEqual(self.resolve(variable, values), expected)
+
+    def test_caches_lookups(self):
+        """ each segment should cache the lookup that found it. """
+        variable = CachedVariable('rows.0.name')
+        variable.resolve(Context({'rows': [self.Product('tea')]}))
+        self.assertEqual(
+            [entry and entry[1] for entry in variable.lookup_cache],
+            [ITEM, INDEX, ATTRIBUTE])
+
+    def test_guard_falls_back(self):
+        """ when the type at a segment changes, or the cached
+        lookup fails, the full lookup should be used.
+        """
+        variable = CachedVariable('row.name')
+        self.assertEqual(
+            variable.resolve(Context({'row': self.Product('tea')})), 'tea')
+        self.assertEqual(
+            variable.resolve(Context({'row': {'name': 'coffee'}})), 'coffee')
+        # a dict without the key falls back to its attributes
+        keys = CachedVariable('row.keys')
+        self.assertEqual(
+            list(keys.resolve(Context({'row': {'keys': ['a']}}))), ['a'])
+        self.assertEqual(
+            list(keys.resolve(Context({'row': {'b': 1}}))), ['b'])
+        self.assertEqual(
+            variable.resolve(Context({'row': self.Product('tea')})), 'tea')
+        self.assertEqual(
+            self.resolve(variable, {'row': object()}),
+            template.VariableDoesNotExist)
+
+    def test_property_errors_raised(self):
+        """ an AttributeError raised inside a property should be
+        raised, with or without a cached lookup.
+        """
+        variable = CachedVariable('row.name')
+        variable.resolve(Context({'row': self.Product('tea')}))
+        with self.assertRaises(AttributeError):
+            variable.resolve(Context({'row': self.Broken()}))
+        variable.lookup_cache[1] = (self.Broken, ATTRIBUTE, 'name')
+        with self.assertRaises(AttributeError):
+            variable.resolve(Context({'row': self.Broken()}))
+
+    def test_macros_use_cached_variables(self):
+        """ call site arguments and variables in macro bodies
+        should be given inline caches.
+        """
+        t = Template(
+            "{% load macros %}{% macro show p %}{{ p.product.name }}"
+            "{% endmacro %}"
+            "{% for row in rows %}{% use_macro show row %}{% endfor %}")
+        self.assertEqual(
+            t.render(Context({'rows': [
+                {'product': self.Product('tea')},
+                {'product': self.Product('coffee')}]})),
+            "teacoffee")
+        macro = t.nodelist.get_nodes_by_type(DefineMacroNode)[0]
+        self.assertIsInstance(
+            macro.nodelist[0].filter_expression.var, CachedVariable)
+        use = t.nodelist.get_nodes_by_type(UseMacroNode)[0]
+        self.assertIsInstance(use.args[0], CachedVariable)
+
+    def test_arguments_are_interned(self):
+        """ call sites and macro bodies repeating an expression
+        should share its parsed parts, but not its inline cache.
+        """
+        t = Template(
+            "{% load macros %}{% macro show p q='btn' %}{{ p.name }}"
+            "{% endmacro %}{% use_macro show item q='btn' %}"
+            "{% use_macro show item q=item %}")
+        first, second = t.nodelist.get_nodes_by_type(UseMacroNode)
+        self.assertIsNot(first.args[0], second.args[0])
+        self.assertIs(first.args[0].lookups, second.args[0].lookups)
+        self.assertIs(first.args[0].lookups, second.kwargs['q'].lookups)
+        self.assertIsNot(
+            first.args[0].lookup_cache, second.args[0].lookup_cache)
+        self.assertIs(first.kwargs['q'], lookups.interned("'btn'"))
+        macro = t.nodelist.get_nodes_by_type(DefineMacroNode)[0]
+        self.assertIs(
+            macro.nodelist[0].filter_expression.var.lookups,
+            lookups.interned('p.name').lookups)
+
+    def test_call_sites_cache_their_own_types(self):
+        """ a call site's inline cache shouldn't be changed by
+        another call site passing other types.
+        """
+        class Item(object):
+            name = "attr"
+        t = Template(
+            "{% load macros %}{% macro show p %}{% endmacro %}"
+            "{% with x=item %}{% use_macro show x.name %}{% endwith %}"
+            "{% with x=row %}{% use_macro show x.name %}{% endwith %}")
+        first, second = t.nodelist.get_nodes_by_type(UseMacroNode)
+        t.render(Context({'item': Item(), 'row': {'name': 'item'}}))
+        self.assertEqual(first.args[0].lookup_cache[1][1], ATTRIBUTE)
+        self.assertEqual(second.args[0].lookup_cache[1][1], ITEM)
+
+
+class FilteredArgumentsTests(TestCase):
+
+    def test_filtered_arguments(self):
+        """ call site arguments may have filters, compiled once
+        and applied as the arguments are bound, without a
+        context push.
+        """
+        t = Template(
+            "{% load macros %}{% macro price amount currency='$' %}"
+            "{{ currency }}{{ amount }}{% endmacro %}"
+            "{% use_macro price row.price|floatformat:2 "
+            "currency=row.currency|default:'EUR'|upper %}"
+            "{% use_macro price 'x'|upper currency=row.missing|default:'' %}")
+        use = t.nodelist.get_nodes_by_type(UseMacroNode)[0]
+        self.assertIsInstance(use.args[0], template_base.FilterExpression)
+        self.assertIsInstance(use.args[0].var, CachedVariable)
+        self.assertEqual(
+            t.render(Context({'row': {'price': 3.14159, 'currency': ''}})),
+            "EUR3.14X")
+
+    def test_filtered_arguments_in_macro_block(self):
+        """ macro_block should accept filtered arguments too. """
+        t = Template(
+            "{% load macros %}{% macro show a b %}{{ a }},{{ b }}"
+            "{% endmacro %}"
+            "{% macro_block show names|join:'-' %}"
+            "{% macro_arg %}x{% endmacro_arg %}{% endmacro_block %}")
+        self.assertEqual(
+            t.render(Context({'names': ['a', 'b']})), "a-b,x")
+
+
+class MemoizedArgumentsTests(TestCase):
+
+    def test_memo_arguments(self):
+        """ a call marked memo should look its dotted arguments
+        up once per render and root object.
+        """
+        calls = []
+
+        class User(object):
+            def __init__(self, name):
+                self.name = name
+
+            @property
+            def profile(self):
+                calls.append(self.name)
+                return self.name.title()
+
+        t = Template(
+            "{% load macros %}{% macro show p %}{{ p }}{% endmacro %}"
+            "{% for i in '123' %}{% use_macro show user.profile memo %}"
+            "{% use_macro show other.profile memo %}"
+            "{% use_macro show user.profile %}{% endfor %}")
+        use = t.nodelist.get_nodes_by_type(UseMacroNode)[0]
+        self.assertIn('memo', use.options)
+        context = Context({'user': User('ann'), 'other': User('bob')})
+        self.assertEqual(t.render(context), "AnnBobAnn" * 3)
+        # the unmarked call looks it up every time
+        self.assertEqual(calls.count('ann'), 1 + 3)
+        self.assertEqual(calls.count('bob'), 1)
+        # and the memo only lasts for the render
+        t.render(context)
+        self.assertEqual(calls.count('bob'), 2)
@@ -0,0 +1,169 @@
+""" writer.py, part of django-macros, renders nodelists into a
+writer (any function taking a string, such as list.append or
+io.StringIO.write) rather than returning a string.
+
+Nodes able to render into a writer, such as macro calls, do so
+through their render_to method, handing the writer down to the
+nodelists inside them. Macros nested several levels deep then
+write their output straight into the outermost buffer, rather
+than each level joining the strings returned by the level
+below, which copies the same output again at every level.
+
+Templates can also be rendered straight to utf-8 bytes, into a
+bytearray. The static text in macro bodies is encoded once, when
+the macro is compiled, and only the dynamic output is encoded as
+it is rendered, so the page needn't be encoded as a whole after.
+"""
+
+from io import StringIO
+
+from django.http import HttpResponse
+from django.template.base import Node, TextNode
+from django.template.loader import get_template
+from django.utils.safestring import mark_safe
+
+try:
+    from django.template.context import make_context
+except ImportError:
+    # Django < 1.8
+    make_context = None
+
+from .streaming import render_node
+
+try:
+    text_type = unicode
+except NameError:
+    # Python 3
+    text_type = str
+
+
+def writes_into(nodelist):
+    """ whether any node directly in nodelist can render into a
+    writer, for which rendering nodelist through a writer pays
+    off. Other nodelists render faster by NodeList.render.
+    """
+    return any(hasattr(node, 'render_to') for node in nodelist)
+
+
+def write_nodelist(nodelist, context, write):
+    """ render nodelist in context into write. """
+    annotated = hasattr(Node, 'render_annotated')
+    for node in nodelist:
+        render_to = getattr(node, 'render_to', None)
+        if render_to is not None:
+            render_to(context, write)
+        elif annotated and isinstance(node, Node):
+            # the common case, inlined from render_node
+            write(text_type(node.render_annotated(context)))
+        else:
+            write(render_node(node, context))
+
+
+def render_nodelist(nodelist, context):
+    """ render nodelist in context through a writer, returning
+    the output as NodeList.render does.
+    """
+    bits = []
+    write_nodelist(nodelist, context, bits.append)
+    return mark_safe(''.join(bits))
+
+
+def render_template_to(template, context, out):
+    """ render template (a django.template.Template) in
+    context into out, a file-like object with a write method.
+    """
+    render_context = context.render_context
+    if hasattr(render_context, 'push_state'):
+        # Django 1.11+
+        with render_context.push_state(template):
+            _render_bound_to(template, context, out.write)
+    else:
+        _render_bound_to(template, context, out.write)
+
+
+def _render_bound_to(template, context, write):
+    if getattr(context, 'template', False) is None:
+        with context.bind_template(template):
+            context.template_name = template.name
+            write_nodelist(template.nodelist, context, write)
+    else:
+        write_nodelist(template.nodelist, context, write)
+
+
+def render_template(template, context):
+    """ render template in context through an io.StringIO
+    buffer, returning the output.
+    """
+    out = StringIO()
+    render_template_to(template, context, out)
+    return mark_safe(out.getvalue())
+
+
+def encode_text_nodes(nodelist):
+    """ store the utf-8 encoding of each TextNode directly in
+    nodelist on the node, for write_nodelist_bytes. (Text in
+    other tags, e.g. {% if %}, is rendered by them as a string.)
+    """
+    for node in nodelist:
+        if isinstance(node, TextNode):
+            node.encoded = node.s.encode('utf-8')
+
+
+def write_nodelist_bytes(nodelist, context, out):
+    """ render nodelist in context into out, a bytearray,
+    as utf-8.
+    """
+    for node in nodelist:
+        if isinstance(node, TextNode):
+            try:
+                out += node.encoded
+            except AttributeError:
+                # text outside of macros isn't encoded ahead
+                node.encoded = node.s.encode('utf-8')
+                out += node.encoded
+            continue
+        render_bytes_to = getattr(node, 'render_bytes_to', None)
+        if render_bytes_to is not None:
+            render_bytes_to(context, out)
+        else:
+            out += render_node(node, context).encode('utf-8')
+
+
+def render_template_bytes(template, context):
+    """ render template (a django.template.Template) in
+    context, returning the output as a utf-8 bytearray.
+    """
+    out = bytearray()
+    render_context = context.render_context
+    if hasattr(render_context, 'push_state'):
+        # Django 1.11+
+        with render_context.push_state(template):
+            _render_bound_bytes(template, context, out)
+    else:
+        _render_bound_bytes(template, context, out)
+    return out
+
+
+def _render_bound_bytes(template, context, out):
+    if getattr(context, 'template', False) is None:
+        with context.bind_template(template):
+            context.template_name = template.name
+            write_nodelist_bytes(template.nodelist, context, out)
+    else:
+        write_nodelist_bytes(template.nodelist, context, out)
+
+
+def bytes_response(request, template_name, context=None, **kwargs):
+    """ return an HttpResponse of template_name rendered with
+    context for request, rendered straight to utf-8. Further
+    keyword arguments (status, ...) are passed to the response.
+    """
+    t = get_template(template_name)
+    t = getattr(t, 'template', t)
+    if make_context is not None:
+        context = make_context(context, request)
+    else:
+        from django.template import RequestContext
+        context = RequestContext(request, context)
+    kwargs.setdefault('content_type', 'text/html; charset=utf-8')
+    return HttpResponse(bytes(render_template_bytes(t, context)), **kwargs)